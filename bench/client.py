@@ -0,0 +1,190 @@
+import aiohttp
+import argparse
+import asyncio
+import fractions
+import json
+import time
+import av
+import numpy as np
+from aiortc import RTCPeerConnection, RTCSessionDescription
+from aiortc.mediastreams import AudioStreamTrack, MediaStreamError
+
+# Headless browser stand-in: sends speech through /offer like static/index.html and times the replies.
+
+CLIENT_SAMPLE_RATE = 48000
+CLIENT_FRAME_MS = 20
+CLIENT_SPEECH_MS = 1500
+CLIENT_PAUSE_MS = 6000
+CLIENT_VOICED_DBFS = -45
+CLIENT_REPLY_GAP_MS = 500 # audio or anim after a longer gap starts a new reply
+
+def dbfs(samples):
+    samples = samples.astype(np.float32) / 32768
+    return 10 * np.log10(np.mean(samples * samples) + 1e-10)
+
+def synthetic_speech(speech_ms=CLIENT_SPEECH_MS, pause_ms=CLIENT_PAUSE_MS, sample_rate=CLIENT_SAMPLE_RATE):
+    # A harmonic, syllable-modulated burst followed by silence, enough for the VAD and the fake ASR.
+    t = np.arange(int(sample_rate * speech_ms / 1000)) / sample_rate
+    voice = sum(np.sin(2 * np.pi * f * t) / (i + 1) for i, f in enumerate((140, 280, 420, 560)))
+    voice *= 0.5 + 0.5 * np.abs(np.sin(2 * np.pi * 3 * t))
+    pause = np.zeros(int(sample_rate * pause_ms / 1000))
+    return (np.concatenate([voice * 6000, pause])).astype(np.int16)
+
+def load_speech(path, pause_ms=CLIENT_PAUSE_MS, sample_rate=CLIENT_SAMPLE_RATE):
+    # Any file av can decode, resampled to s16 mono and followed by a pause so each loop is one turn.
+    resampler = av.AudioResampler(format='s16', layout='mono', rate=sample_rate)
+    with av.open(path) as container:
+        frames = [frame for packet in container.decode(audio=0) for frame in resampler.resample(packet)]
+    samples = np.concatenate([frame.to_ndarray().reshape(-1) for frame in frames])
+    return np.concatenate([samples, np.zeros(int(sample_rate * pause_ms / 1000), dtype=np.int16)])
+
+class SpeechTrack(AudioStreamTrack):
+    # Loops the recording in real time and remembers when each utterance ended.
+    def __init__(self, samples):
+        super().__init__()
+        self.samples = samples
+        self.frame_size = int(CLIENT_SAMPLE_RATE * CLIENT_FRAME_MS / 1000)
+        self.offset = 0
+        self.pts = 0
+        self.start = None
+        self.voiced = False
+        self.speech_ends = []
+
+    async def recv(self):
+        if self.readyState != 'live': raise MediaStreamError
+        if self.start is None: self.start = time.monotonic()
+        else: await asyncio.sleep(max(0, self.start + self.pts / CLIENT_SAMPLE_RATE - time.monotonic()))
+        indices = np.arange(self.offset, self.offset + self.frame_size) % len(self.samples)
+        self.offset = (self.offset + self.frame_size) % len(self.samples)
+        samples = self.samples[indices]
+        voiced = dbfs(samples) > CLIENT_VOICED_DBFS
+        if self.voiced and not voiced: self.speech_ends.append(time.monotonic())
+        self.voiced = voiced
+        frame = av.AudioFrame.from_ndarray(samples.reshape(1, -1), format='s16', layout='mono')
+        frame.sample_rate = CLIENT_SAMPLE_RATE
+        frame.pts = self.pts
+        frame.time_base = fractions.Fraction(1, CLIENT_SAMPLE_RATE)
+        self.pts += self.frame_size
+        return frame
+
+class SessionResult:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.connected = False
+        self.error = None
+        self.speech_ends = []
+        self.reply_starts = []
+        self.anim_starts = []
+        self.audio_frames = 0
+        self.audio_gaps = 0
+        self.anim_messages = 0
+        self.logs = 0
+
+    def turn_latencies(self, starts):
+        # Each reply is matched with the latest utterance that ended before it.
+        latencies = []
+        ends = list(self.speech_ends)
+        for start in starts:
+            before = [end for end in ends if end < start]
+            if not before: continue
+            latencies.append(1000 * (start - before[-1]))
+            ends = [end for end in ends if end > before[-1]]
+        return latencies
+
+async def receive_audio(track, result):
+    last = None
+    last_loud = None
+    try:
+        while True:
+            frame = await track.recv()
+            now = time.monotonic()
+            if last is not None and now - last > 3 * CLIENT_FRAME_MS / 1000: result.audio_gaps += 1
+            last = now
+            result.audio_frames += 1
+            if dbfs(frame.to_ndarray()) > CLIENT_VOICED_DBFS:
+                if last_loud is None or now - last_loud > CLIENT_REPLY_GAP_MS / 1000: result.reply_starts.append(now)
+                last_loud = now
+    except MediaStreamError:
+        pass
+
+async def run_session(url, session_id, samples, duration_s):
+    result = SessionResult(session_id)
+    pc = RTCPeerConnection()
+    speech = SpeechTrack(samples)
+    pc.addTrack(speech)
+    channel = pc.createDataChannel('data', ordered=True)
+    receivers = []
+    last_anim = None
+
+    @channel.on('message')
+    def on_message(message):
+        nonlocal last_anim
+        if isinstance(message, bytes):
+            now = time.monotonic()
+            if last_anim is None or now - last_anim > CLIENT_REPLY_GAP_MS / 1000: result.anim_starts.append(now)
+            last_anim = now
+            result.anim_messages += 1
+        elif json.loads(message).get('kind') == 'log':
+            result.logs += 1
+
+    @pc.on('track')
+    def on_track(track):
+        if track.kind == 'audio': receivers.append(asyncio.create_task(receive_audio(track, result)))
+
+    try:
+        await pc.setLocalDescription(await pc.createOffer())
+        offer = {'sdp': {'sdp': pc.localDescription.sdp, 'type': pc.localDescription.type}, 'session_id': session_id}
+        async with aiohttp.ClientSession() as client:
+            async with client.post(f'{url}/offer', json=offer) as response:
+                response.raise_for_status()
+                answer = await response.json()
+        await pc.setRemoteDescription(RTCSessionDescription(sdp=answer['sdp'], type=answer['type']))
+        result.connected = True
+        await asyncio.sleep(duration_s)
+    except Exception as e:
+        result.error = repr(e)
+    finally:
+        result.speech_ends = speech.speech_ends
+        await pc.close()
+        for receiver in receivers: receiver.cancel()
+    return result
+
+async def run_sessions(url, sessions, duration_s, samples, ramp_s=0.2):
+    async def staggered(index):
+        await asyncio.sleep(index * ramp_s)
+        return await run_session(url, int(time.time() * 1000) + index, samples, duration_s)
+    return await asyncio.gather(*[staggered(i) for i in range(sessions)])
+
+def percentile(values, p):
+    return float(np.percentile(values, p)) if len(values) else None
+
+def summarize(results):
+    latencies = [latency for result in results for latency in result.turn_latencies(result.reply_starts)]
+    anim_latencies = [latency for result in results for latency in result.turn_latencies(result.anim_starts)]
+    return {
+        'sessions': len(results),
+        'connected': sum(result.connected for result in results),
+        'errors': [result.error for result in results if result.error],
+        'turns': len(latencies),
+        'turn_latency_p50_ms': percentile(latencies, 50),
+        'turn_latency_p99_ms': percentile(latencies, 99),
+        'anim_latency_p50_ms': percentile(anim_latencies, 50),
+        'anim_latency_p99_ms': percentile(anim_latencies, 99),
+        'audio_frames': sum(result.audio_frames for result in results),
+        'audio_gaps': sum(result.audio_gaps for result in results),
+        'anim_messages': sum(result.anim_messages for result in results),
+    }
+
+def parser():
+    parser = argparse.ArgumentParser(description='Headless WebRTC sessions against a running run.py')
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--sessions', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--audio', help='recorded speech to send, synthetic speech if omitted')
+    return parser
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    samples = load_speech(args.audio) if args.audio else synthetic_speech()
+    results = asyncio.run(run_sessions(args.url, args.sessions, args.duration, samples))
+    print(json.dumps(summarize(results), indent=2))
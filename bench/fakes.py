@@ -0,0 +1,169 @@
+import aiohttp.web
+import argparse
+import asyncio
+import grpc
+import json
+import numpy as np
+import riva.client.proto.riva_asr_pb2 as rasr
+import riva.client.proto.riva_asr_pb2_grpc as rasr_srv
+import riva.client.proto.riva_tts_pb2 as rtts
+import riva.client.proto.riva_tts_pb2_grpc as rtts_srv
+from nvidia_ace.animation_data.v1_pb2 import AnimationData, SkelAnimation, SkelAnimationHeader, FloatArrayWithTimeCode
+from nvidia_ace.controller.v1_pb2 import AnimationDataStream, AnimationDataStreamHeader
+from nvidia_ace.services.a2f_controller.v1_pb2_grpc import A2FControllerServiceServicer, add_A2FControllerServiceServicer_to_server
+
+# Local stand-ins for everything run.py talks to: Riva ASR/TTS and the A2F controller on one gRPC port
+# (NVCF routes by function-id metadata, here the service name is enough) and an OpenAI-compatible
+# streaming chat endpoint.
+
+FAKE_GRPC_PORT = 50051
+FAKE_LLM_PORT = 8001
+
+ASR_SILENCE_DBFS = -40
+ASR_ENDPOINT_MS = 500 # silence after speech that ends an utterance when the client never half-closes
+TTS_MS_PER_CHAR = 25
+TTS_CHUNK_MS = 100
+A2F_FPS = 30
+A2F_BLEND_SHAPES = tuple(f'blendShape{i}' for i in range(52))
+
+def dbfs(pcm):
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768
+    return 10 * np.log10(np.mean(samples * samples) + 1e-10) if len(samples) else -100.0
+
+def asr_result(transcript):
+    alternative = rasr.SpeechRecognitionAlternative(transcript=transcript)
+    return rasr.StreamingRecognizeResponse(results=[rasr.StreamingRecognitionResult(is_final=True, alternatives=[alternative])])
+
+class FakeAsr(rasr_srv.RivaSpeechRecognitionServicer):
+    # Finalizes an utterance on half-close (VAD mode) or after ASR_ENDPOINT_MS of silence (thread mode).
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000
+        self.utterances = 0
+
+    async def StreamingRecognize(self, requests, context):
+        sample_rate = 48000
+        speech = silence = 0
+        async for request in requests:
+            if request.HasField('streaming_config'):
+                sample_rate = request.streaming_config.config.sample_rate_hertz or sample_rate
+                continue
+            duration_ms = 1000 * len(request.audio_content) / 2 / sample_rate
+            if dbfs(request.audio_content) > ASR_SILENCE_DBFS:
+                speech += duration_ms
+                silence = 0
+            elif speech:
+                silence += duration_ms
+            if speech and silence >= ASR_ENDPOINT_MS:
+                yield await self.final(speech)
+                speech = silence = 0
+        if speech: yield await self.final(speech)
+
+    async def final(self, speech_ms):
+        await asyncio.sleep(self.latency)
+        self.utterances += 1
+        return asr_result(f'Benchmark question {self.utterances} lasting {int(speech_ms)} milliseconds?')
+
+class FakeTts(rtts_srv.RivaSpeechSynthesisServicer):
+    # A tone as long as the text would take to say, streamed in TTS_CHUNK_MS chunks after a first-chunk delay.
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000
+
+    async def SynthesizeOnline(self, request, context):
+        sample_rate = request.sample_rate_hz or 48000
+        samples = int(sample_rate * TTS_MS_PER_CHAR * len(request.text) / 1000)
+        t = np.arange(samples) / sample_rate
+        pcm = (8000 * np.sin(2 * np.pi * 180 * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 3 * t))).astype(np.int16)
+        chunk = int(sample_rate * TTS_CHUNK_MS / 1000)
+        await asyncio.sleep(self.latency)
+        for start in range(0, samples, chunk):
+            yield rtts.SynthesizeSpeechResponse(audio=pcm[start:start + chunk].tobytes())
+
+class FakeA2F(A2FControllerServiceServicer):
+    # Synthetic blendshapes at A2F_FPS following the loudness of the audio received so far.
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000
+
+    async def ProcessAudioStream(self, requests, context):
+        sample_rate = 48000
+        time_code = 0.0
+        header_sent = False
+        async for request in requests:
+            if request.HasField('audio_stream_header'):
+                sample_rate = request.audio_stream_header.audio_header.samples_per_second or sample_rate
+                continue
+            pcm = request.audio_with_emotion.audio_buffer
+            if not header_sent:
+                header = AnimationDataStreamHeader(skel_animation_header=SkelAnimationHeader(blend_shapes=A2F_BLEND_SHAPES))
+                yield AnimationDataStream(animation_data_stream_header=header)
+                header_sent = True
+            duration = len(pcm) / 2 / sample_rate
+            frames = max(1, int(duration * A2F_FPS))
+            level = float(np.clip((dbfs(pcm) + 60) / 60, 0, 1))
+            weights = [FloatArrayWithTimeCode(time_code=time_code + i / A2F_FPS, values=[level] * len(A2F_BLEND_SHAPES)) for i in range(frames)]
+            time_code += duration
+            await asyncio.sleep(self.latency)
+            yield AnimationDataStream(animation_data=AnimationData(skel_animation=SkelAnimation(blend_shape_weights=weights)))
+
+class FakeLlm:
+    # OpenAI-compatible SSE chat completions, every reply differs so the TTS cache doesn't hide synthesis cost.
+    def __init__(self, first_token_ms, token_ms, tokens):
+        self.first_token = first_token_ms / 1000
+        self.token = token_ms / 1000
+        self.tokens = tokens
+        self.replies = 0
+
+    async def completions(self, request):
+        await request.json()
+        self.replies += 1
+        words = [f'Reply {self.replies}.'] + ['This is a synthetic answer sentence.' if i % 6 == 5 else 'word' for i in range(self.tokens)]
+        response = aiohttp.web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        try:
+            await asyncio.sleep(self.first_token)
+            for word in words:
+                data = {'choices': [{'index': 0, 'delta': {'content': word + ' '}}]}
+                await response.write(f'data: {json.dumps(data)}\n\n'.encode('utf-8'))
+                await asyncio.sleep(self.token)
+            await response.write(b'data: [DONE]\n\n')
+        except ConnectionResetError:
+            pass # the client stopped reading, e.g. the user interrupted
+        return response
+
+async def serve(args):
+    server = grpc.aio.server()
+    rasr_srv.add_RivaSpeechRecognitionServicer_to_server(FakeAsr(args.asr_latency_ms), server)
+    rtts_srv.add_RivaSpeechSynthesisServicer_to_server(FakeTts(args.tts_latency_ms), server)
+    add_A2FControllerServiceServicer_to_server(FakeA2F(args.a2f_latency_ms), server)
+    server.add_insecure_port(f'{args.host}:{args.grpc_port}')
+    await server.start()
+
+    llm = FakeLlm(args.llm_first_token_ms, args.llm_token_ms, args.llm_tokens)
+    app = aiohttp.web.Application()
+    app.router.add_post('/v1/chat/completions', llm.completions)
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, args.host, args.llm_port).start()
+    print(f'[ Fakes: gRPC on {args.host}:{args.grpc_port}, LLM on http://{args.host}:{args.llm_port}/v1/chat/completions ]', flush=True)
+    try:
+        await server.wait_for_termination()
+    finally:
+        await runner.cleanup()
+
+def parser():
+    parser = argparse.ArgumentParser(description='Local stand-ins for Riva ASR/TTS, A2F and the LLM')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--grpc-port', type=int, default=FAKE_GRPC_PORT)
+    parser.add_argument('--llm-port', type=int, default=FAKE_LLM_PORT)
+    parser.add_argument('--asr-latency-ms', type=float, default=150)
+    parser.add_argument('--tts-latency-ms', type=float, default=100)
+    parser.add_argument('--a2f-latency-ms', type=float, default=20)
+    parser.add_argument('--llm-first-token-ms', type=float, default=300)
+    parser.add_argument('--llm-token-ms', type=float, default=20)
+    parser.add_argument('--llm-tokens', type=int, default=12)
+    return parser
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve(parser().parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,246 @@
+import aiohttp
+import argparse
+import asyncio
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from bench.client import run_sessions, summarize, synthetic_speech, load_speech
+from bench.fakes import FAKE_GRPC_PORT, FAKE_LLM_PORT
+
+# Starts the fakes and run.py, drives N concurrent headless sessions through it and reports client-side
+# turn latency, the server's /metrics stage latencies and underruns, and server CPU and memory per session.
+
+BENCH_PORT = 5100
+BENCH_READY_TIMEOUT_S = 60
+BENCH_SAMPLE_INTERVAL_S = 1
+BENCH_REGRESSION_TOLERANCE = 0.2
+
+METRIC_LINE = re.compile(r'^(?P<name>\w+)(?:\{(?P<labels>[^}]*)\})? (?P<value>\S+)$')
+METRIC_LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+def process_tree(pid):
+    pids = [pid]
+    for child in pids:
+        try:
+            for task in os.listdir(f'/proc/{child}/task'):
+                with open(f'/proc/{child}/task/{task}/children') as f:
+                    pids.extend(int(p) for p in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+def process_usage(pids):
+    # Summed CPU seconds and resident bytes from /proc (Linux only).
+    ticks = os.sysconf('SC_CLK_TCK')
+    page = os.sysconf('SC_PAGE_SIZE')
+    cpu = rss = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{pid}/statm') as f:
+                rss += int(f.read().split()[1]) * page
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+        except (OSError, IndexError):
+            pass
+    return cpu, rss
+
+class UsageSampler:
+    def __init__(self, pid):
+        self.pid = pid
+        self.samples = []
+
+    async def run(self):
+        while True:
+            self.samples.append((time.monotonic(), *process_usage(process_tree(self.pid))))
+            await asyncio.sleep(BENCH_SAMPLE_INTERVAL_S)
+
+    def summary(self, sessions):
+        if len(self.samples) < 2: return {}
+        (t0, cpu0, _), (t1, cpu1, _) = self.samples[0], self.samples[-1]
+        idle_rss = self.samples[0][2]
+        peak_rss = max(rss for _, _, rss in self.samples)
+        cpu_percent = 100 * (cpu1 - cpu0) / (t1 - t0)
+        return {
+            'cpu_percent': cpu_percent,
+            'cpu_percent_per_session': cpu_percent / sessions,
+            'rss_peak_mb': peak_rss / 2**20,
+            'rss_per_session_mb': (peak_rss - idle_rss) / 2**20 / sessions,
+        }
+
+def parse_metrics(text):
+    metrics = []
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match: metrics.append((match['name'], dict(METRIC_LABEL.findall(match['labels'] or '')), float(match['value'])))
+    return metrics
+
+def histogram_percentile(buckets, p):
+    # Linear interpolation inside the bucket holding the p-th percentile, like Prometheus histogram_quantile.
+    buckets = sorted(buckets)
+    total = buckets[-1][1] if buckets else 0
+    if total == 0: return None
+    rank = p / 100 * total
+    lower, below = 0.0, 0
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            if bound == float('inf'): return lower
+            return lower + (bound - lower) * (rank - below) / max(cumulative - below, 1)
+        lower, below = bound, cumulative
+    return lower
+
+def server_summary(metrics_texts):
+    stages = {}
+    interrupts = {}
+    underruns = late_frames = 0
+    loop_lag_max = 0.0
+    for text in metrics_texts:
+        for name, labels, value in parse_metrics(text):
+            if name == 'avatar_stage_latency_ms_bucket':
+                buckets = stages.setdefault(labels['stage'], {})
+                bound = float(labels['le'])
+                buckets[bound] = buckets.get(bound, 0) + value
+            elif name == 'avatar_interrupt_latency_ms_bucket' and labels['stage'] == 'total':
+                bound = float(labels['le'])
+                interrupts[bound] = interrupts.get(bound, 0) + value
+            elif name == 'avatar_audio_out_underruns_total':
+                underruns += value
+            elif name == 'avatar_audio_out_late_frames_total':
+                late_frames += value
+            elif name == 'avatar_event_loop_lag_max_ms':
+                loop_lag_max = max(loop_lag_max, value)
+    summary = {'underruns': int(underruns), 'late_frames': int(late_frames), 'event_loop_lag_max_ms': loop_lag_max}
+    for stage, buckets in stages.items():
+        buckets = list(buckets.items())
+        summary[f'{stage}_p50_ms'] = histogram_percentile(buckets, 50)
+        summary[f'{stage}_p99_ms'] = histogram_percentile(buckets, 99)
+    if interrupts:
+        summary['interrupts'] = int(interrupts[float('inf')])
+        summary['interrupt_p50_ms'] = histogram_percentile(list(interrupts.items()), 50)
+        summary['interrupt_p99_ms'] = histogram_percentile(list(interrupts.items()), 99)
+    return summary
+
+async def wait_ready(url, process):
+    deadline = time.monotonic() + BENCH_READY_TIMEOUT_S
+    async with aiohttp.ClientSession() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None: raise RuntimeError(f'run.py exited with {process.returncode}')
+            try:
+                async with client.get(f'{url}/load') as response:
+                    load = await response.json() if response.status == 200 else None
+                # In multi-worker mode the dispatcher answers before its workers do, each must report in.
+                if load is not None and not any(isinstance(entry, dict) and 'error' in entry for entry in load.values()): return load
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f'run.py not ready on {url} after {BENCH_READY_TIMEOUT_S}s')
+
+def worker_urls(url, load):
+    # In multi-worker mode the dispatcher's /load is keyed by worker URL, each worker serves its own /metrics.
+    return list(load) if all(key.startswith('http') for key in load) else [url]
+
+async def scrape_metrics(urls):
+    texts = []
+    async with aiohttp.ClientSession() as client:
+        for url in urls:
+            try:
+                async with client.get(f'{url}/metrics') as response:
+                    texts.append(await response.text())
+            except aiohttp.ClientError as e:
+                print(f'Bench Error: no /metrics from {url}: {e}', file=sys.stderr)
+    return texts
+
+def compare(report, baseline, tolerance):
+    # Latencies and underruns that grew by more than tolerance over the baseline report.
+    regressions = []
+    for section in ('client', 'server'):
+        for key, value in report.get(section, {}).items():
+            old = baseline.get(section, {}).get(key)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)): continue
+            if not (key.endswith('_ms') or key == 'underruns'): continue
+            if value > old * (1 + tolerance) and value - old > 1:
+                regressions.append(f'{section}.{key}: {old:.1f} -> {value:.1f}')
+    return regressions
+
+async def bench(args):
+    url = f'http://127.0.0.1:{args.port}'
+    fakes = subprocess.Popen([sys.executable, '-m', 'bench.fakes',
+        '--grpc-port', str(args.grpc_port), '--llm-port', str(args.llm_port),
+        '--llm-first-token-ms', str(args.llm_first_token_ms), '--llm-token-ms', str(args.llm_token_ms),
+        '--llm-tokens', str(args.llm_tokens),
+        '--tts-latency-ms', str(args.tts_latency_ms), '--asr-latency-ms', str(args.asr_latency_ms),
+        '--a2f-latency-ms', str(args.a2f_latency_ms)])
+    cache_dir = tempfile.TemporaryDirectory(prefix='bench-tts-')
+    env = dict(os.environ,
+        NVAPI_KEY=os.getenv('NVAPI_KEY', 'bench'),
+        NVCF_GRPC_URI=f'127.0.0.1:{args.grpc_port}',
+        NVCF_GRPC_USE_SSL='0',
+        LLM_URL=f'http://127.0.0.1:{args.llm_port}/v1/chat/completions',
+        TTS_CACHE_DIR=cache_dir.name,
+        WORKERS=str(args.workers),
+        STREAMING_PORT=str(args.port),
+        DISPATCHER_PORT=str(args.port),
+        WORKER_BASE_PORT=str(args.port + 1),
+    )
+    # Own process group, so stopping it reaches the dispatcher and every worker.
+    server = subprocess.Popen([sys.executable, 'run.py'], env=env, stdout=None if args.verbose else subprocess.DEVNULL, start_new_session=True)
+    try:
+        load = await wait_ready(url, server)
+        samples = load_speech(args.audio) if args.audio else synthetic_speech()
+        sampler = UsageSampler(server.pid)
+        sampling = asyncio.create_task(sampler.run())
+        results = await run_sessions(url, args.sessions, args.duration, samples)
+        sampling.cancel()
+        report = {
+            'config': {key: value for key, value in vars(args).items() if key not in ('json', 'baseline')},
+            'client': summarize(results),
+            'server': server_summary(await scrape_metrics(worker_urls(url, load))),
+            'usage': sampler.summary(args.sessions),
+        }
+    finally:
+        os.killpg(server.pid, signal.SIGINT)
+        try: server.wait(timeout=15)
+        except subprocess.TimeoutExpired: os.killpg(server.pid, signal.SIGKILL)
+        fakes.terminate()
+        fakes.wait()
+        cache_dir.cleanup()
+    return report
+
+def parser():
+    parser = argparse.ArgumentParser(description='Concurrent-session benchmark of run.py against local fakes')
+    parser.add_argument('--sessions', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=60, help='seconds each session stays connected')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--audio', help='recorded speech to send, synthetic speech if omitted')
+    parser.add_argument('--port', type=int, default=BENCH_PORT)
+    parser.add_argument('--grpc-port', type=int, default=FAKE_GRPC_PORT)
+    parser.add_argument('--llm-port', type=int, default=FAKE_LLM_PORT)
+    parser.add_argument('--asr-latency-ms', type=float, default=150)
+    parser.add_argument('--tts-latency-ms', type=float, default=100)
+    parser.add_argument('--a2f-latency-ms', type=float, default=20)
+    parser.add_argument('--llm-first-token-ms', type=float, default=300)
+    parser.add_argument('--llm-token-ms', type=float, default=20)
+    parser.add_argument('--llm-tokens', type=int, default=12)
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--baseline', help='earlier --json report, exit 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=BENCH_REGRESSION_TOLERANCE)
+    parser.add_argument('--verbose', action='store_true', help='show run.py output')
+    return parser
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    report = asyncio.run(bench(args))
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions: print(f'Regression: {regression}')
+        sys.exit(1 if regressions else 0)
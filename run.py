@@ -1,19 +1,58 @@
 import asyncio
-from services.streaming import Streaming 
+import multiprocessing
+import os
+import signal
+from services.streaming import Streaming
 from services.speech import Speech
 from services.interaction import Interaction
 from services.animation import Animation
-from services.common.bus import Bus
+from services.dispatcher import Dispatcher, DISPATCHER_PORT
+from services.common.bus import Bus, SESSION_POLICIES
+from services.common.grpc_pool import warm_pools, close_pools
 
-if __name__ == '__main__':
-    bus = Bus()
-    services = [Streaming(bus), Speech(bus), Interaction(bus), Animation(bus)]
-    loop = asyncio.get_event_loop()
+WORKERS = int(os.getenv('WORKERS', '1'))
+WORKER_HOST = os.getenv('WORKER_HOST', '127.0.0.1')
+WORKER_BASE_PORT = int(os.getenv('WORKER_BASE_PORT', str(DISPATCHER_PORT + 1)))
+WORKER_STOP_TIMEOUT_S = 15
+
+def run_services(services, setup=None, teardown=None):
+    # SIGTERM shuts down like Ctrl-C, later signals are ignored so they can't cut the shutdown short.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if setup is not None: loop.run_until_complete(setup())
     try:
         tasks = [service.run() for service in services]
         loop.run_until_complete(asyncio.gather(*tasks))
     except KeyboardInterrupt:
         print('Shutting down...')
-        pass
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
     tasks = [service.shutdown() for service in services]
-    loop.run_until_complete(asyncio.gather(*tasks))
\ No newline at end of file
+    loop.run_until_complete(asyncio.gather(*tasks))
+    if teardown is not None: loop.run_until_complete(teardown())
+
+def run_worker(host=None, port=None):
+    # Full stack for the sessions routed to this process, each worker opens and warms its own gRPC pools.
+    bus = Bus(policies=SESSION_POLICIES)
+    streaming = Streaming(bus) if port is None else Streaming(bus, host, port, serve_assets=False)
+    run_services([streaming, Speech(bus), Interaction(bus), Animation(bus)], warm_pools, close_pools)
+
+if __name__ == '__main__':
+    if WORKERS <= 1:
+        run_worker()
+    else:
+        # spawn rather than fork, gRPC channels and event loops must not be inherited.
+        context = multiprocessing.get_context('spawn')
+        ports = [WORKER_BASE_PORT + i for i in range(WORKERS)]
+        workers = [context.Process(target=run_worker, args=(WORKER_HOST, port), daemon=True) for port in ports]
+        for worker in workers: worker.start()
+        try:
+            run_services([Dispatcher([f'http://{WORKER_HOST}:{port}' for port in ports])])
+        finally:
+            # Workers only see a signal sent to the process group (Ctrl-C), so stop them explicitly.
+            for worker in workers:
+                if worker.is_alive(): worker.terminate()
+            for worker in workers:
+                worker.join(WORKER_STOP_TIMEOUT_S)
+                if worker.is_alive(): worker.kill()
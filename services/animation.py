@@ -1,48 +1,25 @@
 import asyncio
-import os
 import grpc
-import av
+import numpy as np
+from itertools import chain
 from nvidia_ace.a2f.v1_pb2 import AudioWithEmotion, EmotionPostProcessingParameters, FaceParameters, BlendShapeParameters
 from nvidia_ace.services.a2f_controller.v1_pb2_grpc import A2FControllerServiceStub
 from nvidia_ace.audio.v1_pb2 import AudioHeader
 from nvidia_ace.controller.v1_pb2 import AudioStream, AudioStreamHeader
+from services.common.audio import resample_audio
+from services.common.grpc_pool import channel_pool, nvcf_metadata
+from services.common.session import SessionService
+from services.common.metrics import metrics
 
-NVAPI_KEY = os.getenv('NVAPI_KEY')
+A2F_FUNCTION_ID = '52f51a79-324c-4dbe-90ad-798ab665ad64'
 
 A2F_SAMPLE_RATE = 48000
 
-async def nv_a2f_service_stream():
-    metadata=[
-        ('function-id', '52f51a79-324c-4dbe-90ad-798ab665ad64'),
-        ('authorization', 'Bearer ' + NVAPI_KEY)
-    ]
-    creds = grpc.ssl_channel_credentials(None)
-    def metadata_callback(context, callback):
-        callback(metadata, None)
-    auth_creds = grpc.metadata_call_credentials(metadata_callback)
-    creds = grpc.composite_channel_credentials(creds, auth_creds)
-    channel = grpc.aio.secure_channel("grpc.nvcf.nvidia.com:443", creds)
+async def nv_a2f_service_stream(channel):
     stub = A2FControllerServiceStub(channel)
-    return stub.ProcessAudioStream()
+    return stub.ProcessAudioStream(metadata=nvcf_metadata(A2F_FUNCTION_ID))
 
-async def resample_audio(audio, target_sample_rate=48000, chunk_size_ms=100):
-    chunk_size = int(2 * target_sample_rate * chunk_size_ms / 1000)
-    resampler = av.AudioResampler(
-        format='s16',
-        layout='mono',
-        rate=target_sample_rate,
-    )
-    buffer = bytearray()
-    async for frame in audio:
-        resampled_frames = resampler.resample(frame)
-        for frame in resampled_frames:
-            buffer.extend(bytes(frame.planes[0]))
-        while len(buffer) >= chunk_size:
-            chunk = buffer[:chunk_size]
-            yield bytes(chunk)
-            buffer = buffer[chunk_size:]
-
-async def a2f_write_to_stream(stream, audio, sample_rate=A2F_SAMPLE_RATE):
+async def a2f_write_to_stream(stream, chunks, sample_rate=A2F_SAMPLE_RATE):
     audio_stream_header = AudioStream(
         audio_stream_header=AudioStreamHeader(
             audio_header=AudioHeader(
@@ -57,53 +34,86 @@ async def a2f_write_to_stream(stream, audio, sample_rate=A2F_SAMPLE_RATE):
         )
     )
     await stream.write(audio_stream_header)
-    async for chunk in resample_audio(audio, target_sample_rate=A2F_SAMPLE_RATE):
+    async for chunk in chunks:
         await stream.write(AudioStream(audio_with_emotion=AudioWithEmotion(audio_buffer=chunk)))
 
+class AnimChunk:
+    # One animation_data message: time_codes (n,) float64 and values (n, len(names)) float32, names is
+    # the tuple from the stream header shared by every chunk of that stream. time_codes are seconds on
+    # the audio_out timeline (frame pts / sample rate), pts is filled in by the consumer.
+    __slots__ = ('names', 'time_codes', 'values', 'pts')
+
+    def __init__(self, names, time_codes, values):
+        self.names = names
+        self.time_codes = time_codes
+        self.values = values
+        self.pts = None
+
+    def __len__(self):
+        return len(self.time_codes)
+
 async def a2f_read_from_stream(stream):
-    bs_names = []    
+    bs_names = ()
     while True:
         message = await stream.read()
         if message == grpc.aio.EOF:
             break
         elif message.HasField("animation_data_stream_header"):
             animation_data_stream_header = message.animation_data_stream_header
-            bs_names = animation_data_stream_header.skel_animation_header.blend_shapes
+            bs_names = tuple(animation_data_stream_header.skel_animation_header.blend_shapes)
         elif message.HasField("animation_data"):
             animation_data = message.animation_data
             bs_list = animation_data.skel_animation.blend_shape_weights
-            for blendshapes in bs_list:
-                bs_values_dict = dict(zip(bs_names, blendshapes.values))
-                yield {
-                    "timeCode": blendshapes.time_code,
-                    "blendShapes": bs_values_dict
-                }
+            if not bs_list: continue
+            time_codes = np.fromiter((blendshapes.time_code for blendshapes in bs_list), dtype=np.float64, count=len(bs_list))
+            values = np.fromiter(chain.from_iterable(blendshapes.values for blendshapes in bs_list), dtype=np.float32, count=len(bs_list) * len(bs_names))
+            yield AnimChunk(bs_names, time_codes, values.reshape((len(bs_list), len(bs_names))))
 
 async def animation_handler(bus, session_id):
     audio_out = bus.subscribe(f'/sessions/{session_id}/audio_out')
+    interrupts = bus.subscribe(f'/sessions/{session_id}/interrupt')
 
-    async def audio():
+    async def frames(first):
+        yield first
         while True:
-            frame = await audio_out.get()
-            yield frame
-    
-    stream = await nv_a2f_service_stream()
-    writer = asyncio.create_task(a2f_write_to_stream(stream, audio()))
-
-    async for keyframe in a2f_read_from_stream(stream):
-        await bus.publish(f'/sessions/{session_id}/anim_out', keyframe)
+            yield await audio_out.get()
 
-class Animation:
-    def __init__(self, bus):
-        self.bus = bus
-        self.session_new = bus.subscribe('/session_new')
-        self.handlers = {}
+    async def a2f_stream(channel):
+        # Opened on the first audio_out frame, A2F time codes count from there so they are offset by its pts.
+        first = await audio_out.get()
+        base_time = first.pts / first.sample_rate
+        stream = await nv_a2f_service_stream(channel)
+        writer = asyncio.create_task(a2f_write_to_stream(stream, resample_audio(frames(first), A2F_SAMPLE_RATE)))
+        try:
+            async for chunk in a2f_read_from_stream(stream):
+                chunk.time_codes += base_time
+                metrics().mark(session_id, 'anim_out', after='audio_out')
+                await bus.publish(f'/sessions/{session_id}/anim_out', chunk)
+        finally:
+            writer.cancel()
+            stream.cancel()
 
-    async def run(self):
-        while True:
-            session_id = await self.session_new.get()
-            self.handlers[session_id] = asyncio.create_task(animation_handler(self.bus, session_id))
+    with channel_pool().acquire() as lease:
+        interrupted = asyncio.create_task(interrupts.get())
+        streaming = None
+        try:
+            while True:
+                # An interrupt resets the stream, so A2F drops the buffered audio of the cancelled reply.
+                streaming = asyncio.create_task(a2f_stream(lease.channel))
+                done, _ = await asyncio.wait((streaming, interrupted), return_when=asyncio.FIRST_COMPLETED)
+                streaming.cancel()
+                await asyncio.gather(streaming, return_exceptions=True)
+                if interrupted in done:
+                    turn, started = interrupted.result()
+                    audio_out.drain()
+                    metrics().interrupted(session_id, 'a2f', started)
+                    interrupted = asyncio.create_task(interrupts.get())
+                elif not streaming.cancelled():
+                    streaming.result()
+        finally:
+            interrupted.cancel()
+            if streaming is not None: streaming.cancel()
 
-    async def shutdown(self):
-        self.bus.unsubscribe('/session_new', self.session_new)
-        await asyncio.gather(*self.handlers.values())
+class Animation(SessionService):
+    def handler(self, session_id):
+        return animation_handler(self.bus, session_id)
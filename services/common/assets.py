@@ -0,0 +1,227 @@
+import aiohttp.web
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+try:
+    import brotli
+except ImportError:
+    brotli = None # gzip only, pip install brotli for smaller transfers
+
+ASSETS_DIR = os.getenv('ASSETS_DIR', 'static')
+ASSETS_CACHE_DIR = os.getenv('ASSETS_CACHE_DIR', '.cache/assets')
+ASSETS_MEMORY_MAX_BYTES = int(os.getenv('ASSETS_MEMORY_MAX_BYTES', str(1 << 20))) # larger files are streamed from disk
+ASSETS_BROTLI_QUALITY = int(os.getenv('ASSETS_BROTLI_QUALITY', '9'))
+ASSETS_GZIP_LEVEL = 9
+ASSETS_COMPRESS_MIN_BYTES = 1024
+ASSETS_COMPRESS_MIN_SAVING = 0.1 # a variant saving less than this is not worth decompressing in the browser
+ASSETS_CHUNK_BYTES = 256 << 10
+ASSETS_INDEX = 'index.html'
+ASSETS_INCOMPRESSIBLE = ('.gz', '.br', '.zip', '.png', '.jpg', '.jpeg', '.webp', '.mp4', '.webm', '.woff2')
+CACHE_IMMUTABLE = 'public, max-age=31536000, immutable'
+CACHE_REVALIDATE = 'no-cache'
+
+ASSET_URL = re.compile(r'(?<![\w/.-])/?assets/([\w.-]+)')
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+mimetypes.add_type('model/gltf-binary', '.glb')
+mimetypes.add_type('image/x-exr', '.exr')
+
+_assets = None
+
+def compress(data, encoding):
+    if encoding == 'br': return brotli.compress(data, quality=ASSETS_BROTLI_QUALITY)
+    return gzip.compress(data, ASSETS_GZIP_LEVEL, mtime=0)
+
+def encodings():
+    # Preferred first.
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+def negotiate(accept_encoding, available):
+    # Best available content-coding the client accepts with q > 0, None for identity.
+    accepted = {}
+    for part in accept_encoding.lower().split(','):
+        coding, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try: q = float(params[2:])
+            except ValueError: q = 0.0
+        accepted[coding.strip()] = q
+    for encoding in encodings():
+        if encoding in available and accepted.get(encoding, accepted.get('*', 0)) > 0: return encoding
+    return None
+
+def etag_matches(header, etag):
+    if header is None: return False
+    tags = [tag.strip().removeprefix('W/') for tag in header.split(',')]
+    return '*' in tags or etag in tags
+
+def parse_range(header, size):
+    # A single byte range as (start, end exclusive). Anything else, including an invalid spec like
+    # bytes=5-2, is ignored and the whole body is served (RFC 9110 14.2).
+    match = BYTE_RANGE.match(header.strip())
+    if match is None or not (match[1] or match[2]): return None
+    if not match[1]:
+        start, end = max(0, size - int(match[2])), size
+        if int(match[2]) == 0: start = size
+    else:
+        start = int(match[1])
+        if match[2] and int(match[2]) < start: return None
+        end = min(int(match[2]) + 1, size) if match[2] else size
+    if start >= size:
+        raise aiohttp.web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{size}'})
+    return start, end
+
+def fingerprint(name, digest):
+    stem, ext = os.path.splitext(name)
+    return f'{stem}.{digest[:12]}{ext}'
+
+class Asset:
+    # One file's identity bytes and its precompressed variants keyed by content-coding. Each is held as
+    # bytes when small enough, otherwise as a path that is streamed per request.
+    __slots__ = ('name', 'content_type', 'digest', 'size', 'source', 'variants', 'compressible')
+
+    def __init__(self, name, source, digest, size):
+        content_type, _ = mimetypes.guess_type(name)
+        if content_type is None: content_type = 'application/octet-stream'
+        if content_type.startswith('text/'): content_type += '; charset=utf-8'
+        self.name = name
+        self.content_type = content_type
+        self.digest = digest
+        self.size = size
+        self.source = source
+        self.variants = {}
+        self.compressible = size >= ASSETS_COMPRESS_MIN_BYTES and not name.lower().endswith(ASSETS_INCOMPRESSIBLE)
+
+    @classmethod
+    def from_file(cls, name, path, memory_bytes):
+        size = os.path.getsize(path)
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            if size <= memory_bytes:
+                data = f.read()
+                sha.update(data)
+                return cls(name, data, sha.hexdigest(), size)
+            for block in iter(lambda: f.read(ASSETS_CHUNK_BYTES), b''): sha.update(block)
+        return cls(name, path, sha.hexdigest(), size)
+
+    def etag(self, encoding=None):
+        # Strong and per representation, a gzip body must not validate a cached brotli one.
+        return f'"{self.digest[:16]}-{encoding}"' if encoding else f'"{self.digest[:16]}"'
+
+    def read(self):
+        if isinstance(self.source, bytes): return self.source
+        with open(self.source, 'rb') as f:
+            return f.read()
+
+class AssetStore:
+    # static/ as served to browsers: index.html is rewritten to fingerprinted /assets/ URLs, which are
+    # cached for a year, the page and plain names revalidate by ETag. gzip/brotli variants are built once
+    # into a cache directory keyed by content hash (compress() at startup, or python -m services.common.assets)
+    # and picked by Accept-Encoding. Range requests are served from the identity bytes.
+    def __init__(self, directory=ASSETS_DIR, cache_dir=ASSETS_CACHE_DIR, memory_bytes=ASSETS_MEMORY_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.assets = {}
+        self.urls = {}
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+            if not entry.is_file() or entry.name.startswith('.') or entry.name == ASSETS_INDEX: continue
+            asset = Asset.from_file(entry.name, entry.path, memory_bytes)
+            versioned = fingerprint(entry.name, asset.digest)
+            self.assets[entry.name] = (asset, False)
+            self.assets[versioned] = (asset, True)
+            self.urls[entry.name] = f'/assets/{versioned}'
+        with open(os.path.join(directory, ASSETS_INDEX), encoding='utf-8') as f:
+            page = ASSET_URL.sub(lambda match: self.urls.get(match[1], match[0]), f.read()).encode('utf-8')
+        self.index_asset = Asset(ASSETS_INDEX, page, hashlib.sha256(page).hexdigest(), len(page))
+        self.assets[ASSETS_INDEX] = (self.index_asset, False)
+
+    def compress(self):
+        # Blocking, run it in a thread. Assets are served uncompressed until their variants exist.
+        os.makedirs(self.cache_dir, exist_ok=True)
+        unique = {id(asset): asset for asset, _ in self.assets.values()}
+        for asset in unique.values():
+            if not asset.compressible: continue
+            for encoding in encodings():
+                if encoding in asset.variants: continue
+                path = os.path.join(self.cache_dir, f'{asset.digest}.{encoding}')
+                if not os.path.exists(path):
+                    tmp = f'{path}.{os.getpid()}.tmp'
+                    with open(tmp, 'wb') as f:
+                        f.write(compress(asset.read(), encoding))
+                    os.replace(tmp, path)
+                size = os.path.getsize(path)
+                if size > asset.size * (1 - ASSETS_COMPRESS_MIN_SAVING): continue
+                if size <= self.memory_bytes:
+                    with open(path, 'rb') as f:
+                        asset.variants[encoding] = f.read()
+                else:
+                    asset.variants[encoding] = path
+
+    async def index(self, request):
+        return await self.respond(request, self.index_asset, CACHE_REVALIDATE)
+
+    async def asset(self, request):
+        entry = self.assets.get(request.match_info['name'])
+        if entry is None: raise aiohttp.web.HTTPNotFound()
+        asset, immutable = entry
+        return await self.respond(request, asset, CACHE_IMMUTABLE if immutable else CACHE_REVALIDATE)
+
+    async def respond(self, request, asset, cache_control):
+        byte_range = request.headers.get('Range')
+        if byte_range is not None and request.headers.get('If-Range', asset.etag()) != asset.etag(): byte_range = None
+        encoding = None if byte_range is not None else negotiate(request.headers.get('Accept-Encoding', ''), asset.variants)
+        headers = {'ETag': asset.etag(encoding), 'Cache-Control': cache_control, 'Accept-Ranges': 'bytes'}
+        if asset.compressible: headers['Vary'] = 'Accept-Encoding'
+        if etag_matches(request.headers.get('If-None-Match'), headers['ETag']):
+            return aiohttp.web.Response(status=304, headers=headers)
+        headers['Content-Type'] = asset.content_type
+        source = asset.source
+        size = asset.size
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+            source = asset.variants[encoding]
+            size = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+        status = 200
+        start, end = 0, size
+        if byte_range is not None:
+            bounds = parse_range(byte_range, size)
+            if bounds is not None:
+                start, end = bounds
+                status = 206
+                headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        if isinstance(source, bytes):
+            body = source if (start, end) == (0, size) else source[start:end]
+            return aiohttp.web.Response(status=status, body=body, headers=headers)
+        response = aiohttp.web.StreamResponse(status=status, headers=headers)
+        response.content_length = end - start
+        await response.prepare(request)
+        if request.method == 'HEAD': return response
+        with open(source, 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                block = await asyncio.to_thread(f.read, min(ASSETS_CHUNK_BYTES, remaining))
+                if not block: break
+                remaining -= len(block)
+                await response.write(block)
+        await response.write_eof()
+        return response
+
+def assets():
+    global _assets
+    if _assets is None:
+        _assets = AssetStore()
+    return _assets
+
+if __name__ == '__main__':
+    # Prebuilds the compressed variants, e.g. in an image build, so startup finds them in the cache.
+    store = assets()
+    store.compress()
+    for name, (asset, immutable) in store.assets.items():
+        if immutable or name == ASSETS_INDEX:
+            sizes = ', '.join(f'{encoding} {len(v) if isinstance(v, bytes) else os.path.getsize(v)}' for encoding, v in asset.variants.items())
+            print(f'{name}: {asset.size} bytes' + (f' ({sizes})' if sizes else ''))
@@ -0,0 +1,88 @@
+import asyncio
+import av
+
+PCM_CHUNK_SIZE_MS = 100
+
+_stages = {}
+
+class PcmRing:
+    def __init__(self, capacity):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def grow(self, capacity):
+        size = self.size
+        buffer = bytearray(capacity)
+        buffer[:size] = self.read(size)
+        self.buffer, self.view, self.start, self.size = buffer, memoryview(buffer), 0, size
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        capacity = len(self.buffer)
+        if self.size + len(data) > capacity:
+            self.grow(max(2 * capacity, self.size + len(data)))
+            capacity = len(self.buffer)
+        end = (self.start + self.size) % capacity
+        first = min(len(data), capacity - end)
+        self.view[end:end + first] = data[:first]
+        self.view[:len(data) - first] = data[first:]
+        self.size += len(data)
+
+    def read(self, n):
+        # Only the returned chunk is copied, the remaining buffer never moves.
+        capacity = len(self.buffer)
+        end = self.start + n
+        if end <= capacity: chunk = bytes(self.view[self.start:end])
+        else: chunk = b''.join((self.view[self.start:], self.view[:end - capacity]))
+        self.start = end % capacity
+        self.size -= n
+        return chunk
+
+async def resample_audio(audio, target_sample_rate, chunk_size_ms=PCM_CHUNK_SIZE_MS):
+    chunk_size = int(2 * target_sample_rate * chunk_size_ms / 1000)
+    resampler = None
+    ring = PcmRing(4 * chunk_size)
+    async for frame in audio:
+        if frame.format.name != 's16' or frame.layout.name != 'mono' or frame.sample_rate != target_sample_rate:
+            if resampler is None:
+                resampler = av.AudioResampler(format='s16', layout='mono', rate=target_sample_rate)
+            resampled_frames = resampler.resample(frame)
+        else:
+            resampled_frames = (frame,)
+        for frame in resampled_frames:
+            ring.write(memoryview(frame.planes[0])[:2 * frame.samples])
+        while len(ring) >= chunk_size:
+            yield ring.read(chunk_size)
+
+async def pcm_stage_handler(bus, queue, out_topic, sample_rate, chunk_size_ms):
+    async def frames():
+        while True:
+            yield await queue.get()
+    async for chunk in resample_audio(frames(), sample_rate, chunk_size_ms):
+        await bus.publish(out_topic, chunk)
+
+def start_stage(bus, out_topic, handler):
+    # handler() subscribes to the stage inputs and returns its coroutine, it is only called for the first consumer.
+    if (bus, out_topic) not in _stages:
+        _stages[(bus, out_topic)] = asyncio.create_task(handler())
+    return out_topic
+
+async def stop_stages(bus, prefix):
+    tasks = [_stages.pop(key) for key in list(_stages) if key[0] is bus and key[1].startswith(prefix)]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return len(tasks)
+
+def pcm_stage(bus, topic, sample_rate, chunk_size_ms=PCM_CHUNK_SIZE_MS):
+    # One resampler/chunker per (topic, rate, chunk size), shared by every consumer of the returned topic.
+    out_topic = f'{topic}/pcm/{sample_rate}/{chunk_size_ms}'
+    def handler():
+        queue = bus.subscribe(topic)
+        return pcm_stage_handler(bus, queue, out_topic, sample_rate, chunk_size_ms)
+    return start_stage(bus, out_topic, handler)
@@ -1,19 +1,100 @@
 import asyncio
+import fnmatch
 from collections import defaultdict
 
+# Queue policies applied when a subscriber's queue is full.
+BLOCK = 'block'              # publisher waits for space
+DROP_OLDEST = 'drop_oldest'  # oldest queued message is discarded
+COALESCE = 'coalesce'        # only the latest message is kept
+
+# Bounded mode for per-session media topics, see Bus(policies=...).
+SESSION_POLICIES = {
+    '/sessions/*/video_in': (1, COALESCE),
+    '/sessions/*/audio_in': (50, DROP_OLDEST),
+    '/sessions/*/audio_out': (50, DROP_OLDEST),
+    '/sessions/*/audio_out/delayed': (50, DROP_OLDEST),
+    '/sessions/*/anim_out': (100, DROP_OLDEST),
+}
+
+class TopicQueue(asyncio.Queue):
+    def __init__(self, maxsize=0, policy=BLOCK):
+        super().__init__(maxsize)
+        self.policy = policy
+        self.published = 0
+        self.dropped = 0
+
+    def offer(self, message):
+        # Delivers without waiting where the policy allows it, returns False if the publisher has to block.
+        self.published += 1
+        if self.policy == COALESCE:
+            self.dropped += self.drain()
+        elif self.policy == DROP_OLDEST and self.full():
+            self.get_nowait()
+            self.dropped += 1
+        elif self.full():
+            return False
+        self.put_nowait(message)
+        return True
+
+    def drain(self):
+        count = 0
+        while not self.empty():
+            self.get_nowait()
+            count += 1
+        return count
+
+    def stats(self):
+        return {
+            'policy': self.policy,
+            'maxsize': self.maxsize,
+            'lag': self.qsize(),
+            'published': self.published,
+            'dropped': self.dropped,
+        }
+
 class Bus:
-    def __init__(self):
+    def __init__(self, policies=None):
         self.subscribers = defaultdict(list)
+        self.policies = dict(policies or {})
+
+    def configure(self, pattern, maxsize=0, policy=BLOCK):
+        self.policies[pattern] = (maxsize, policy)
+
+    def policy(self, topic):
+        for pattern, policy in self.policies.items():
+            if fnmatch.fnmatchcase(topic, pattern):
+                return policy
+        return (0, BLOCK)
 
     async def publish(self, topic, message):
-        for queue in self.subscribers[topic]:
-            await queue.put(message)
+        # Fan out without waiting on each queue in turn, only full BLOCK queues are awaited (concurrently).
+        blocked = [queue.put(message) for queue in self.subscribers.get(topic, ()) if not queue.offer(message)]
+        if len(blocked) == 1: await blocked[0]
+        elif blocked: await asyncio.gather(*blocked)
 
-    def subscribe(self, topic):
-        queue = asyncio.Queue()
+    def subscribe(self, topic, maxsize=None, policy=None):
+        default_maxsize, default_policy = self.policy(topic)
+        queue = TopicQueue(default_maxsize if maxsize is None else maxsize, policy or default_policy)
         self.subscribers[topic].append(queue)
         return queue
 
     def unsubscribe(self, topic, queue):
         if queue in self.subscribers[topic]:
-            self.subscribers[topic].remove(queue)
\ No newline at end of file
+            self.subscribers[topic].remove(queue)
+        if not self.subscribers[topic]:
+            del self.subscribers[topic]
+
+    def close_topics(self, prefix):
+        # Drops every topic under prefix, returns how many queues and queued messages were released.
+        queues = messages = 0
+        for topic in [topic for topic in self.subscribers if topic.startswith(prefix)]:
+            for queue in self.subscribers.pop(topic):
+                messages += queue.drain()
+                queues += 1
+        return queues, messages
+
+    def has_subscribers(self, topic):
+        return bool(self.subscribers.get(topic))
+
+    def stats(self):
+        return {topic: [queue.stats() for queue in queues] for topic, queues in self.subscribers.items()}
@@ -0,0 +1,131 @@
+import asyncio
+import os
+import grpc
+
+NVAPI_KEY = os.getenv('NVAPI_KEY')
+
+NVCF_GRPC_URI = os.getenv('NVCF_GRPC_URI', 'grpc.nvcf.nvidia.com:443')
+NVCF_GRPC_USE_SSL = os.getenv('NVCF_GRPC_USE_SSL', '1') == '1'
+GRPC_MAX_STREAMS_PER_CHANNEL = int(os.getenv('GRPC_MAX_STREAMS_PER_CHANNEL', '64'))
+GRPC_WARM_TIMEOUT_S = 10
+GRPC_KEEPALIVE_MS = int(os.getenv('GRPC_KEEPALIVE_MS', '60000'))
+# Pings only while streams are open, servers GOAWAY clients pinging idle connections more often than every
+# 5 minutes by default, which would drop exactly the warmed channels.
+GRPC_CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', GRPC_KEEPALIVE_MS),
+    ('grpc.keepalive_timeout_ms', 10000),
+    ('grpc.keepalive_permit_without_calls', 0),
+]
+
+UNHEALTHY = (grpc.ChannelConnectivity.TRANSIENT_FAILURE, grpc.ChannelConnectivity.SHUTDOWN)
+
+_pools = {}
+
+def nvcf_metadata(function_id):
+    # Auth travels per call, so one channel can carry streams for every NVCF function.
+    return (('function-id', function_id), ('authorization', f'Bearer {NVAPI_KEY}'))
+
+class PooledChannel:
+    __slots__ = ('channel', 'streams', 'state')
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.streams = 0
+        self.state = grpc.ChannelConnectivity.IDLE
+
+class ChannelLease:
+    def __init__(self, pool, entry):
+        self.pool = pool
+        self.entry = entry
+        self.channel = entry.channel
+
+    def release(self):
+        if self.entry is not None:
+            self.pool.release(self.entry)
+            self.entry = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class ChannelPool:
+    # Hands out leases on shared channels, opening a new channel only when every healthy one already
+    # carries max_streams streams. aio pools serve grpc.aio stubs, sync pools serve riva.client services
+    # running in threads.
+    def __init__(self, uri=NVCF_GRPC_URI, use_ssl=NVCF_GRPC_USE_SSL, aio=True, max_streams=GRPC_MAX_STREAMS_PER_CHANNEL):
+        self.uri = uri
+        self.use_ssl = use_ssl
+        self.aio = aio
+        self.max_streams = max_streams
+        self.entries = []
+        self.retired = []
+
+    def open(self):
+        module = grpc.aio if self.aio else grpc
+        if self.use_ssl: channel = module.secure_channel(self.uri, grpc.ssl_channel_credentials(), options=GRPC_CHANNEL_OPTIONS)
+        else: channel = module.insecure_channel(self.uri, options=GRPC_CHANNEL_OPTIONS)
+        entry = PooledChannel(channel)
+        if not self.aio:
+            channel.subscribe(lambda state: setattr(entry, 'state', state))
+        self.entries.append(entry)
+        return entry
+
+    def state(self, entry):
+        return entry.channel.get_state() if self.aio else entry.state
+
+    def close_channel(self, entry):
+        if self.aio: asyncio.ensure_future(entry.channel.close())
+        else: entry.channel.close()
+
+    def check(self):
+        # Unhealthy channels take no new streams and are closed once their last stream is released.
+        for entry in list(self.entries):
+            if self.state(entry) in UNHEALTHY:
+                self.entries.remove(entry)
+                if entry.streams == 0: self.close_channel(entry)
+                else: self.retired.append(entry)
+
+    def acquire(self):
+        self.check()
+        entry = next((entry for entry in self.entries if entry.streams < self.max_streams), None) or self.open()
+        entry.streams += 1
+        return ChannelLease(self, entry)
+
+    def release(self, entry):
+        entry.streams -= 1
+        if entry.streams == 0 and entry in self.retired:
+            self.retired.remove(entry)
+            self.close_channel(entry)
+
+    async def warm(self, timeout=GRPC_WARM_TIMEOUT_S):
+        entry = self.entries[0] if self.entries else self.open()
+        try:
+            if self.aio: await asyncio.wait_for(entry.channel.channel_ready(), timeout)
+            else: await asyncio.to_thread(grpc.channel_ready_future(entry.channel).result, timeout)
+        except (asyncio.TimeoutError, grpc.FutureTimeoutError):
+            print(f'gRPC Error: {self.uri} not ready after {timeout}s')
+
+    async def close(self):
+        for entry in self.entries + self.retired:
+            if self.aio: await entry.channel.close()
+            else: entry.channel.close()
+        self.entries.clear()
+        self.retired.clear()
+
+    def stats(self):
+        return [{'streams': entry.streams, 'state': self.state(entry).name} for entry in self.entries]
+
+def channel_pool(aio=True):
+    key = (NVCF_GRPC_URI, aio)
+    if key not in _pools:
+        _pools[key] = ChannelPool(aio=aio)
+    return _pools[key]
+
+async def warm_pools():
+    await asyncio.gather(channel_pool(aio=True).warm(), channel_pool(aio=False).warm())
+
+async def close_pools():
+    await asyncio.gather(*[pool.close() for pool in _pools.values()])
+    _pools.clear()
@@ -0,0 +1,206 @@
+import asyncio
+import bisect
+import time
+
+METRICS_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+METRICS_LOOP_INTERVAL_S = 0.5
+METRICS_STAGES = ('asr_final', 'llm_first_token', 'llm_last_token', 'tts_first_chunk', 'audio_out', 'anim_out')
+INTERRUPT_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 250)
+INTERRUPT_STAGES = ('llm', 'tts', 'audio', 'anim', 'a2f')
+PLAYOUT_SERIES = (
+    ('underruns_total', 'underruns', 'counter'),
+    ('late_frames_total', 'late_frames', 'counter'),
+    ('dropped_frames_total', 'dropped_frames', 'counter'),
+    ('delay_line_frames', 'delay_line', 'gauge'),
+    ('delay_ms', 'delay_ms', 'gauge'),
+)
+HISTORY_SERIES = (
+    ('budget_tokens', 'budget', 'gauge'),
+    ('tokens', 'tokens', 'gauge'),
+    ('messages', 'messages', 'gauge'),
+    ('summary_tokens', 'summary_tokens', 'gauge'),
+    ('compactions_total', 'compactions', 'counter'),
+    ('compaction_seconds_total', 'compaction_time_s', 'counter'),
+    ('dropped_messages_total', 'dropped_messages', 'counter'),
+)
+TTS_CACHE_SERIES = (
+    ('hits_total', 'hits', 'counter'),
+    ('disk_hits_total', 'disk_hits', 'counter'),
+    ('misses_total', 'misses', 'counter'),
+    ('hit_rate', 'hit_rate', 'gauge'),
+    ('memory_entries', 'memory_entries', 'gauge'),
+    ('memory_bytes', 'memory_bytes', 'gauge'),
+    ('disk_entries', 'disk_entries', 'gauge'),
+    ('disk_bytes', 'disk_bytes', 'gauge'),
+    ('disk_evictions_total', 'disk_evictions', 'counter'),
+)
+
+_metrics = None
+
+def label(value):
+    # Prometheus text format label value escaping, session ids come straight from the client.
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=METRICS_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, lines, name, labels=''):
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {self.count}')
+        labels = f'{{{labels.rstrip(",")}}}' if labels else ''
+        lines.append(f'{name}_sum{labels} {self.sum:.3f}')
+        lines.append(f'{name}_count{labels} {self.count}')
+
+class SessionTrace:
+    # Timestamps of the current turn, which starts at the ASR final and is measured from the end of speech.
+    __slots__ = ('audio_in', 'speech_end', 'start', 'marks', 'histograms', 'interrupt', 'interrupted', 'history')
+
+    def __init__(self):
+        self.audio_in = None
+        self.speech_end = None
+        self.start = None
+        self.marks = {}
+        self.histograms = {}
+        self.interrupt = None
+        self.interrupted = set()
+        self.history = None
+
+class Metrics:
+    # Per-hop latency since the end of the user's speech, one observation per stage per turn, aggregated
+    # per session and globally. Recording is a clock read and a few dict lookups, so it stays on.
+    def __init__(self):
+        self.sessions = {}
+        self.histograms = {stage: Histogram() for stage in METRICS_STAGES}
+        self.interrupts = {stage: Histogram(INTERRUPT_BUCKETS_MS) for stage in INTERRUPT_STAGES + ('total',)}
+        self.loop_lag = Histogram()
+        self.loop_lag_max = 0.0
+
+    def trace(self, session_id):
+        trace = self.sessions.get(session_id)
+        if trace is None:
+            trace = self.sessions[session_id] = SessionTrace()
+        return trace
+
+    def audio_in(self, session_id):
+        self.trace(session_id).audio_in = time.monotonic()
+
+    def speech_end(self, session_id, trailing_ms=0):
+        self.trace(session_id).speech_end = time.monotonic() - trailing_ms / 1000
+
+    def turn(self, session_id):
+        # Without VAD there is no speech end, so the turn falls back to the last inbound audio frame.
+        trace = self.trace(session_id)
+        now = time.monotonic()
+        trace.start = trace.speech_end or trace.audio_in or now
+        trace.speech_end = None
+        trace.marks.clear()
+        self.observe(trace, 'asr_final', now)
+
+    def mark(self, session_id, stage, after=None):
+        # Only the first mark of a stage in a turn counts; with after, only once that stage was reached.
+        trace = self.sessions.get(session_id)
+        if trace is None or trace.start is None or stage in trace.marks: return
+        if after is not None and after not in trace.marks: return
+        self.observe(trace, stage, time.monotonic())
+
+    def observe(self, trace, stage, now):
+        trace.marks[stage] = now
+        latency_ms = 1000 * (now - trace.start)
+        self.histograms[stage].observe(latency_ms)
+        histogram = trace.histograms.get(stage)
+        if histogram is None:
+            histogram = trace.histograms[stage] = Histogram()
+        histogram.observe(latency_ms)
+
+    def interrupted(self, session_id, stage, started):
+        # Time from detecting the interruption until stage dropped its work, total once every stage has.
+        trace = self.trace(session_id)
+        latency_ms = 1000 * (time.monotonic() - started)
+        self.interrupts[stage].observe(latency_ms)
+        if trace.interrupt != started:
+            trace.interrupt = started
+            trace.interrupted = set()
+        trace.interrupted.add(stage)
+        if len(trace.interrupted) == len(INTERRUPT_STAGES): self.interrupts['total'].observe(latency_ms)
+
+    def history(self, session_id, history):
+        # The session's ConversationHistory, its stats() are rendered per session until close.
+        self.trace(session_id).history = history
+
+    def close(self, session_id):
+        self.sessions.pop(session_id, None)
+
+    async def monitor_loop(self, interval=METRICS_LOOP_INTERVAL_S):
+        # Event-loop lag is how late a sleep wakes up.
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(interval)
+            lag_ms = 1000 * max(0.0, time.monotonic() - start - interval)
+            self.loop_lag.observe(lag_ms)
+            self.loop_lag_max = max(self.loop_lag_max, lag_ms)
+
+    def render(self, bus, playouts={}, tts_cache=None, anim_syncs={}):
+        # Prometheus text exposition format.
+        lines = ['# TYPE avatar_stage_latency_ms histogram']
+        for stage, histogram in self.histograms.items():
+            histogram.render(lines, 'avatar_stage_latency_ms', f'stage="{stage}",')
+        lines.append('# TYPE avatar_session_stage_latency_ms histogram')
+        for session_id, trace in self.sessions.items():
+            for stage, histogram in trace.histograms.items():
+                histogram.render(lines, 'avatar_session_stage_latency_ms', f'session="{label(session_id)}",stage="{stage}",')
+        lines.append('# TYPE avatar_interrupt_latency_ms histogram')
+        for stage, histogram in self.interrupts.items():
+            histogram.render(lines, 'avatar_interrupt_latency_ms', f'stage="{stage}",')
+        lines.append('# TYPE avatar_event_loop_lag_ms histogram')
+        self.loop_lag.render(lines, 'avatar_event_loop_lag_ms')
+        lines.append('# TYPE avatar_event_loop_lag_max_ms gauge')
+        lines.append(f'avatar_event_loop_lag_max_ms {self.loop_lag_max:.3f}')
+        # One series per subscriber queue (index in subscription order), so a slow consumer stands out.
+        queues = [(topic, index, stats) for topic, subscribers in bus.stats().items() for index, stats in enumerate(subscribers)]
+        for name, key, kind in (('queue_depth', 'lag', 'gauge'), ('published_total', 'published', 'counter'), ('dropped_total', 'dropped', 'counter')):
+            lines.append(f'# TYPE avatar_bus_{name} {kind}')
+            for topic, index, stats in queues:
+                lines.append(f'avatar_bus_{name}{{topic="{label(topic)}",subscriber="{index}",policy="{stats["policy"]}"}} {stats[key]}')
+        histories = {session_id: trace.history.stats() for session_id, trace in self.sessions.items() if trace.history is not None}
+        for name, key, kind in HISTORY_SERIES:
+            lines.append(f'# TYPE avatar_history_{name} {kind}')
+            for session_id, history in histories.items():
+                lines.append(f'avatar_history_{name}{{session="{label(session_id)}"}} {history[key]:g}')
+        stats = {session_id: playout.stats() for session_id, playout in playouts.items()}
+        for name, key, kind in PLAYOUT_SERIES:
+            lines.append(f'# TYPE avatar_audio_out_{name} {kind}')
+            for session_id, playout in stats.items():
+                lines.append(f'avatar_audio_out_{name}{{session="{label(session_id)}"}} {playout[key]:g}')
+        syncs = {session_id: sync.stats() for session_id, sync in anim_syncs.items()}
+        lines.append('# TYPE avatar_anim_a2f_latency_ms gauge')
+        for session_id, sync in syncs.items():
+            if sync['a2f_latency_ms'] is not None:
+                lines.append(f'avatar_anim_a2f_latency_ms{{session="{label(session_id)}"}} {sync["a2f_latency_ms"]:.1f}')
+        lines.append('# TYPE avatar_anim_late_chunks_total counter')
+        for session_id, sync in syncs.items():
+            lines.append(f'avatar_anim_late_chunks_total{{session="{label(session_id)}"}} {sync["late_chunks"]}')
+        if tts_cache is not None:
+            for name, key, kind in TTS_CACHE_SERIES:
+                lines.append(f'# TYPE avatar_tts_cache_{name} {kind}')
+                lines.append(f'avatar_tts_cache_{name} {tts_cache[key]:g}')
+        return '\n'.join(lines) + '\n'
+
+def metrics():
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
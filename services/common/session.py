@@ -0,0 +1,107 @@
+import asyncio
+from collections import Counter
+from services.common.audio import stop_stages
+
+SESSION_CLOSE_TIMEOUT_S = 5
+
+async def cancel_tasks(tasks):
+    tasks = [task for task in tasks if task is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return len(tasks)
+
+def report_failure(task):
+    # Done callback for background tasks nobody awaits, whose errors would otherwise surface only at GC.
+    if not task.cancelled() and task.exception() is not None:
+        print(f'Task Error: {task.get_name()} failed with {task.exception()!r}')
+
+def background_task(coro, name):
+    task = asyncio.create_task(coro, name=name)
+    task.add_done_callback(report_failure)
+    return task
+
+class SessionService:
+    # Runs the subclass's handler(session_id) coroutine for every /session_new and cancels it on
+    # /session_end, acknowledging on /session_closed so the SessionRegistry knows when the session's
+    # queues can be reclaimed.
+    def __init__(self, bus):
+        self.bus = bus
+        self.session_new = bus.subscribe('/session_new')
+        self.session_end = bus.subscribe('/session_end')
+        self.handlers = {}
+
+    def stop(self, session_id):
+        pass
+
+    async def run(self):
+        await asyncio.gather(self.run_new(), self.run_end())
+
+    async def run_new(self):
+        while True:
+            session_id = await self.session_new.get()
+            self.handlers[session_id] = background_task(self.handler(session_id), f'{type(self).__name__}.handler({session_id})')
+
+    async def run_end(self):
+        while True:
+            session_id = await self.session_end.get()
+            tasks = await cancel_tasks([self.handlers.pop(session_id, None)])
+            self.stop(session_id)
+            await self.bus.publish('/session_closed', (session_id, type(self).__name__, tasks))
+
+    async def shutdown(self):
+        self.bus.unsubscribe('/session_new', self.session_new)
+        self.bus.unsubscribe('/session_end', self.session_end)
+        await cancel_tasks(self.handlers.values())
+        for session_id in list(self.handlers):
+            self.stop(session_id)
+        self.handlers.clear()
+
+class SessionRegistry:
+    # Tracks live sessions and tears one down: cancels the caller's tasks, has every SessionService cancel
+    # its handler, then stops the shared audio stages and drains and drops every /sessions/{id}/ topic.
+    def __init__(self, bus):
+        self.bus = bus
+        self.live = set()
+        self.opened = 0
+        self.closed = 0
+        self.reclaimed = Counter()
+
+    def open(self, session_id):
+        self.live.add(session_id)
+        self.opened += 1
+
+    async def close(self, session_id, tasks=()):
+        if session_id not in self.live: return
+        self.live.discard(session_id)
+        reclaimed = Counter(tasks=await cancel_tasks(tasks))
+
+        acks = self.bus.subscribe('/session_closed')
+        expected = len(self.bus.subscribers.get('/session_end', ()))
+        await self.bus.publish('/session_end', session_id)
+        try:
+            async with asyncio.timeout(SESSION_CLOSE_TIMEOUT_S):
+                while expected > 0:
+                    closed_id, service, tasks = await acks.get()
+                    if closed_id != session_id: continue
+                    reclaimed['tasks'] += tasks
+                    expected -= 1
+        except TimeoutError:
+            print(f'[ Session {session_id}: {expected} services did not acknowledge close ]')
+        finally:
+            self.bus.unsubscribe('/session_closed', acks)
+
+        prefix = f'/sessions/{session_id}/'
+        reclaimed['stages'] = await stop_stages(self.bus, prefix)
+        reclaimed['queues'], reclaimed['messages'] = self.bus.close_topics(prefix)
+        self.reclaimed.update(reclaimed)
+        self.closed += 1
+        print(f'[ Session {session_id} closed, reclaimed {dict(reclaimed)}, {len(self.live)} live ]')
+
+    def stats(self):
+        return {
+            'live': len(self.live),
+            'opened': self.opened,
+            'closed': self.closed,
+            'reclaimed': dict(self.reclaimed),
+        }
@@ -0,0 +1,117 @@
+import hashlib
+import mmap
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', '.cache/tts')
+TTS_CACHE_MEMORY_BYTES = int(os.getenv('TTS_CACHE_MEMORY_BYTES', str(64 << 20)))
+TTS_CACHE_DISK_BYTES = int(os.getenv('TTS_CACHE_DISK_BYTES', str(1 << 30))) # least recently used files are deleted beyond this
+
+_cache = None
+
+def tts_cache_key(text, voice, language, sample_rate):
+    return hashlib.sha256(f'{voice}\0{language}\0{sample_rate}\0{text}'.encode('utf-8')).hexdigest()
+
+class TtsCache:
+    # Raw int16 PCM keyed by content hash: an in-memory LRU of synthesized audio in front of one file per
+    # utterance on disk, itself an LRU bounded by disk_bytes. Disk hits are read through mmap, so they are
+    # served from the page cache without copying and don't count against the memory budget.
+    def __init__(self, directory=TTS_CACHE_DIR, memory_bytes=TTS_CACHE_MEMORY_BYTES, disk_bytes=TTS_CACHE_DISK_BYTES):
+        self.directory = directory
+        self.memory_limit = memory_bytes
+        self.disk_limit = disk_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        files = sorted((entry.stat().st_mtime, entry.name[:-4], entry.stat().st_size) for entry in os.scandir(directory) if entry.name.endswith('.pcm'))
+        self.disk = OrderedDict((key, size) for _, key, size in files)
+        self.disk_bytes = sum(self.disk.values())
+        self.evict_disk()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.pcm')
+
+    def remember(self, key, pcm):
+        if key in self.memory: return
+        self.memory[key] = pcm
+        self.memory_bytes += pcm.nbytes
+        while self.memory_bytes > self.memory_limit and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted.nbytes
+
+    def evict_disk(self):
+        while self.disk_bytes > self.disk_limit and self.disk:
+            key, size = self.disk.popitem(last=False)
+            self.disk_bytes -= size
+            self.evictions += 1
+            try: os.remove(self.path(key))
+            except FileNotFoundError: pass
+
+    def get(self, key):
+        with self.lock:
+            pcm = self.memory.get(key)
+            if pcm is not None:
+                self.memory.move_to_end(key)
+                if key in self.disk: self.disk.move_to_end(key)
+                self.hits += 1
+                return pcm
+            if key not in self.disk:
+                self.misses += 1
+                return None
+            try:
+                with open(self.path(key), 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (FileNotFoundError, ValueError):
+                self.disk_bytes -= self.disk.pop(key)
+                self.misses += 1
+                return None
+            self.disk.move_to_end(key)
+            self.hits += 1
+            self.disk_hits += 1
+            return np.frombuffer(mapped, dtype=np.int16)
+
+    def put(self, key, pcm):
+        path = self.path(key)
+        with self.lock:
+            stored = key in self.disk
+        if not stored:
+            tmp = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(pcm.tobytes())
+            os.replace(tmp, path)
+        with self.lock:
+            if key not in self.disk:
+                self.disk[key] = pcm.nbytes
+                self.disk_bytes += pcm.nbytes
+                self.evict_disk()
+            self.remember(key, pcm)
+
+    def __contains__(self, key):
+        return key in self.memory or key in self.disk
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'memory_entries': len(self.memory),
+            'memory_bytes': self.memory_bytes,
+            'disk_entries': len(self.disk),
+            'disk_bytes': self.disk_bytes,
+            'disk_evictions': self.evictions,
+        }
+
+def tts_cache():
+    global _cache
+    if _cache is None:
+        _cache = TtsCache()
+    return _cache
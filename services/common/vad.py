@@ -0,0 +1,77 @@
+import os
+from collections import deque
+import numpy as np
+from services.common.audio import pcm_stage, start_stage, PCM_CHUNK_SIZE_MS
+
+VAD_ENABLED = os.getenv('VAD_ENABLED', '1') == '1'
+VAD_FRAME_MS = 10
+VAD_THRESHOLD_DB = 12 # above the adaptive noise floor
+VAD_MIN_DBFS = -50
+VAD_MAX_ZCR = 0.4 # fraction of sign changes per sample, higher is treated as noise
+VAD_HANGOVER_MS = 400
+VAD_PREROLL_MS = 300
+
+class VoiceActivityDetector:
+    # Energy plus zero-crossing detector evaluated on 10 ms sub-frames of each PCM chunk at once,
+    # with a hangover so short pauses inside an utterance don't end it.
+    def __init__(self, sample_rate, chunk_size_ms=PCM_CHUNK_SIZE_MS):
+        self.frame_size = int(sample_rate * VAD_FRAME_MS / 1000)
+        self.chunk_size_ms = chunk_size_ms
+        self.noise_db = VAD_MIN_DBFS - VAD_THRESHOLD_DB
+        self.hangover = 0
+        self.active = False
+
+    def voiced(self, chunk):
+        samples = np.frombuffer(chunk, dtype=np.int16)
+        count = len(samples) // self.frame_size
+        frames = samples[:count * self.frame_size].reshape((count, self.frame_size)).astype(np.float32) / 32768
+        energy_db = 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+        zcr = np.count_nonzero(np.diff(np.signbit(frames), axis=1), axis=1) / self.frame_size
+        voiced = (energy_db > max(self.noise_db + VAD_THRESHOLD_DB, VAD_MIN_DBFS)) & (zcr < VAD_MAX_ZCR)
+        # The noise floor follows the quietest sub-frame, falling fast and rising slowly.
+        quietest = float(energy_db.min())
+        self.noise_db += (0.5 if quietest < self.noise_db else 0.02) * (quietest - self.noise_db)
+        return bool(voiced.any())
+
+    def update(self, chunk):
+        # Returns 'start' or 'stop' when the speech state changes, None otherwise.
+        if self.voiced(chunk):
+            self.hangover = VAD_HANGOVER_MS
+        else:
+            self.hangover = max(0, self.hangover - self.chunk_size_ms)
+        if self.hangover > 0 and not self.active:
+            self.active = True
+            return 'start'
+        if self.hangover == 0 and self.active:
+            self.active = False
+            return 'stop'
+
+async def vad_stage_handler(bus, queue, out_topic, event_topic, sample_rate):
+    detector = VoiceActivityDetector(sample_rate)
+    preroll = deque(maxlen=max(1, VAD_PREROLL_MS // PCM_CHUNK_SIZE_MS))
+    while True:
+        chunk = await queue.get()
+        event = detector.update(chunk)
+        if event == 'start':
+            await bus.publish(event_topic, event)
+            while preroll:
+                await bus.publish(out_topic, preroll.popleft())
+        if detector.active or event == 'stop':
+            await bus.publish(out_topic, chunk)
+        else:
+            preroll.append(chunk)
+        if event == 'stop':
+            # None marks the end of an utterance so ASR can finalize without waiting for its own endpointing.
+            await bus.publish(out_topic, None)
+            await bus.publish(event_topic, event)
+
+def vad_stage(bus, session_id, sample_rate):
+    # Speech-only PCM chunks (plus pre-roll and hangover padding) for the session's inbound audio,
+    # start/stop events go to /sessions/{id}/vad.
+    topic = pcm_stage(bus, f'/sessions/{session_id}/audio_in', sample_rate)
+    out_topic = f'/sessions/{session_id}/audio_in/speech/{sample_rate}'
+    event_topic = f'/sessions/{session_id}/vad'
+    def handler():
+        queue = bus.subscribe(topic)
+        return vad_stage_handler(bus, queue, out_topic, event_topic, sample_rate)
+    return start_stage(bus, out_topic, handler)
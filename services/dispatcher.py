@@ -0,0 +1,67 @@
+import aiohttp
+import aiohttp.web
+import asyncio
+import os
+import zlib
+from services.common.assets import assets
+from services.common.session import background_task, cancel_tasks
+
+DISPATCHER_HOST = os.getenv('DISPATCHER_HOST', '0.0.0.0')
+DISPATCHER_PORT = int(os.getenv('DISPATCHER_PORT', '5000'))
+DISPATCHER_TIMEOUT_S = 30
+
+def worker_index(session_id, workers):
+    # Stable across processes and restarts (unlike hash()), so every offer for a session reaches the same worker.
+    return zlib.crc32(str(session_id).encode('utf-8')) % workers
+
+class Dispatcher:
+    # Front door in multi-worker mode: serves the page and assets, routes /offer to the worker owning the
+    # session and aggregates /load. Media never passes through here, ICE connects the browser to the worker.
+    def __init__(self, workers, host=DISPATCHER_HOST, port=DISPATCHER_PORT):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.client = None
+        self.background = []
+        app = aiohttp.web.Application()
+        app.router.add_get('/', assets().index)
+        app.router.add_post('/offer', self.offer)
+        app.router.add_get('/load', self.load)
+        app.router.add_get('/assets/{name}', assets().asset)
+        self.runner = aiohttp.web.AppRunner(app)
+
+    async def run(self):
+        self.client = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=DISPATCHER_TIMEOUT_S))
+        await self.runner.setup()
+        site = aiohttp.web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.background = [background_task(asyncio.to_thread(assets().compress), 'assets.compress')]
+        print(f"[ Dispatching on {self.host}:{self.port} to {len(self.workers)} workers ]")
+        while True: await asyncio.sleep(999)
+
+    async def shutdown(self):
+        await cancel_tasks(self.background)
+        await self.runner.cleanup()
+        if self.client is not None: await self.client.close()
+
+    async def offer(self, request):
+        body = await request.read()
+        params = await request.json()
+        worker = self.workers[worker_index(params.get('session_id'), len(self.workers))]
+        try:
+            async with self.client.post(f'{worker}/offer', data=body, headers={'Content-Type': 'application/json'}) as response:
+                return aiohttp.web.Response(body=await response.read(), status=response.status, content_type=response.content_type)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f'Dispatcher Error: {worker} {e}')
+            raise aiohttp.web.HTTPBadGateway()
+
+    async def worker_load(self, worker):
+        try:
+            async with self.client.get(f'{worker}/load') as response:
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return {'error': str(e)}
+
+    async def load(self, request):
+        loads = await asyncio.gather(*[self.worker_load(worker) for worker in self.workers])
+        return aiohttp.web.json_response(dict(zip(self.workers, loads)))
@@ -2,89 +2,309 @@ import asyncio
 import aiohttp
 import os
 import json
+import re
+import time
+from collections import deque
+from services.common.session import SessionService
+from services.common.metrics import metrics
+from services.common.vad import VAD_ENABLED
 
 NVAPI_KEY = os.getenv('NVAPI_KEY')
 
+LLM_URL = os.getenv('LLM_URL', 'https://integrate.api.nvidia.com/v1/chat/completions')
+LLM_MAX_CONNECTIONS = 100
+LLM_DNS_CACHE_S = 300
+LLM_KEEPALIVE_S = 60
+
+# "content" as a key of the flat "delta" object only, so logprobs or tool call contents never match.
+SSE_DELTA_CONTENT = re.compile(rb'"delta":\s*\{(?:[^{}"]|"(?:[^"\\]|\\.)*")*?"content":\s*"((?:[^"\\]|\\.)*)"')
+
+BARGE_IN = os.getenv('BARGE_IN', '1') == '1' # interrupt the avatar as soon as VAD hears the user, not only on a new transcript
+
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '2048'))
+HISTORY_KEEP_MESSAGES = 6 # most recent messages always sent verbatim
+HISTORY_SUMMARIZE = os.getenv('HISTORY_SUMMARIZE', '1') == '1' # compact evicted turns into a summary, otherwise just drop them
+HISTORY_SUMMARY_PROMPT = '''
+Summarize the following conversation between a user and an assistant in a few sentences.
+Keep names, facts and open questions, and write nothing but the summary.
+'''
+
+_llm_client = None
+
 SYSTEM_PROMPT = '''
 You are a helpful assistant. You answer in a conversational tone.
 Keep your messages brief to allow a quick exchange of dialogue.
 '''
 
-async def interaction_handler(bus, session_id):
-    # return
+# Sentence ends (and newlines) always close a TTS segment, clause breaks only once the segment is long enough.
+SEGMENT_BOUNDARY = re.compile(r'(?P<sentence>[.!?]+["\')\]]*)\s+|(?P<clause>[,;:])\s+|\n+')
+SEGMENT_MIN_CLAUSE_CHARS = 40
+# A period after a title, common abbreviation or initials (J., U.S., e.g.) doesn't end a sentence.
+SEGMENT_ABBREVIATION = re.compile(r'(?:^|[^\w.])(?:(?:Mr|Mrs|Ms|Dr|Prof|Sr|Jr|St|Mt|Gen|Col|Capt|Lt|Sgt|Rev|Hon|vs|etc|approx|No|Fig|Inc|Ltd|Co|Corp|Dept|Jan|Feb|Mar|Apr|Jun|Jul|Aug|Sep|Sept|Oct|Nov|Dec)|(?:[A-Za-z]\.)*[A-Za-z])\.$')
+
+class SentenceSplitter:
+    def __init__(self, min_clause_chars=SEGMENT_MIN_CLAUSE_CHARS):
+        self.min_clause_chars = min_clause_chars
+        self.buffer = ''
+
+    def feed(self, text):
+        self.buffer += text
+        segments = []
+        start = 0
+        for match in SEGMENT_BOUNDARY.finditer(self.buffer):
+            if match.group('clause') and match.end() - start < self.min_clause_chars: continue
+            if match.group('sentence') == '.' and SEGMENT_ABBREVIATION.search(self.buffer, start, match.end('sentence')): continue
+            segment = self.buffer[start:match.end()].strip()
+            if segment: segments.append(segment)
+            start = match.end()
+        self.buffer = self.buffer[start:]
+        return segments
+
+    def flush(self):
+        segment, self.buffer = self.buffer.strip(), ''
+        return segment
+
+class SSEParser:
+    # Splits raw response bytes into SSE data payloads without decoding or copying whole lines.
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+        payloads = []
+        start = 0
+        while (end := self.buffer.find(b'\n', start)) != -1:
+            if self.buffer.startswith(b'data:', start):
+                payload = bytes(self.buffer[start + 5:end]).strip()
+                if payload: payloads.append(payload)
+            start = end + 1
+        del self.buffer[:start]
+        return payloads
+
+def sse_delta_content(payload):
+    # Fast path pulls choices[0].delta.content straight out of the bytes, anything unusual goes through json.
+    match = SSE_DELTA_CONTENT.search(payload)
+    if match:
+        content = match.group(1)
+        if b'\\' not in content: return content.decode('utf-8')
+        return json.loads(b'"' + content + b'"')
+    choices = json.loads(payload).get('choices')
+    return choices[0]['delta'].get('content') if choices else None # e.g. the usage-only final chunk
+
+def llm_client():
+    global _llm_client
+    if _llm_client is None or _llm_client.closed:
+        connector = aiohttp.TCPConnector(
+            limit=LLM_MAX_CONNECTIONS,
+            ttl_dns_cache=LLM_DNS_CACHE_S,
+            keepalive_timeout=LLM_KEEPALIVE_S,
+        )
+        _llm_client = aiohttp.ClientSession(connector=connector, headers={
+            'Authorization': f'Bearer {NVAPI_KEY}',
+            'Content-Type': 'application/json',
+        })
+    return _llm_client
+
+async def close_llm_client():
+    global _llm_client
+    if _llm_client is not None:
+        await _llm_client.close()
+        _llm_client = None
+
+async def completions_create(messages):
+    payload = {
+        "model": "meta/llama3-8b-instruct",
+        "messages": messages,
+        "temperature": 0.5,
+        "top_p": 1,
+        "max_tokens": 128,
+        "stream": True,
+    }
+    try:
+        async with llm_client().post(LLM_URL, json=payload) as response:
+            if response.status == 200:
+                parser = SSEParser()
+                async for data in response.content.iter_any():
+                    for event in parser.feed(data):
+                        if event.startswith(b'[DONE]'): return
+                        try:
+                            content = sse_delta_content(event)
+                        except (json.JSONDecodeError, KeyError, IndexError) as e:
+                            print(f'LLM API Error: {e!r}')
+                            continue
+                        if content: yield content
+            else:
+                print(f'LLM API Error: Status code {response.status}')
+    except aiohttp.ClientError as e:
+        print(f'HTTP Error: {e}')
+
+def estimate_tokens(text):
+    # ~4 characters per token plus per-message overhead, good enough for budgeting without a tokenizer.
+    return len(text) // 4 + 4
+
+class ConversationHistory:
+    # Keeps the system prompt and recent messages verbatim within a token budget. Token counts are cached
+    # per message and summed incrementally, older messages are evicted and summarized in the background.
+    def __init__(self, system_prompt, budget=HISTORY_TOKEN_BUDGET, keep_messages=HISTORY_KEEP_MESSAGES, summarize=HISTORY_SUMMARIZE):
+        self.system_prompt = system_prompt
+        self.budget = budget
+        self.keep_messages = keep_messages
+        self.summarize = summarize
+        self.summary = ''
+        self.system = {'role': 'system', 'content': system_prompt}
+        self.system_tokens = estimate_tokens(system_prompt)
+        self.messages = deque()
+        self.tokens = self.system_tokens
+        self.evicted = []
+        self.compactor = None
+        self.compactions = 0
+        self.compaction_time = 0.0
+        self.dropped_messages = 0
+
+    def __getitem__(self, index):
+        return self.messages[index][0] if self.messages else self.system
+
+    def append(self, role, content):
+        tokens = estimate_tokens(content)
+        self.messages.append(({'role': role, 'content': content}, tokens))
+        self.tokens += tokens
+        if self.tokens > self.budget: self.evict()
+
+    def payload(self):
+        return [self.system] + [message for message, _ in self.messages]
+
+    def evict(self):
+        # Evicts oldest first and never leaves an assistant message at the front.
+        while self.messages and (self.tokens > self.budget and len(self.messages) > self.keep_messages or self.messages[0][0]['role'] == 'assistant'):
+            message, tokens = self.messages.popleft()
+            self.tokens -= tokens
+            self.evicted.append(message)
+        if not self.summarize:
+            self.dropped_messages += len(self.evicted)
+            self.evicted.clear()
+        elif self.evicted and self.compactor is None:
+            self.compactor = asyncio.create_task(self.compact())
+
+    def set_summary(self, summary):
+        self.summary = summary
+        content = self.system_prompt + '\nSummary of the earlier conversation: ' + summary
+        self.tokens += estimate_tokens(content) - self.system_tokens
+        self.system = {'role': 'system', 'content': content}
+        self.system_tokens = estimate_tokens(content)
+
+    async def compact(self):
+        try:
+            while self.evicted:
+                start = time.monotonic()
+                evicted, self.evicted = self.evicted, []
+                transcript = '\n'.join(f"{message['role']}: {message['content']}" for message in evicted)
+                if self.summary: transcript = f'(earlier) {self.summary}\n{transcript}'
+                prompt = [{'role': 'system', 'content': HISTORY_SUMMARY_PROMPT}, {'role': 'user', 'content': transcript}]
+                summary = ''.join([chunk async for chunk in completions_create(prompt)]).strip()
+                if summary: self.set_summary(summary)
+                else: self.dropped_messages += len(evicted)
+                self.compactions += 1
+                self.compaction_time += time.monotonic() - start
+        finally:
+            self.compactor = None
+
+    def stats(self):
+        return {
+            'budget': self.budget,
+            'tokens': self.tokens,
+            'messages': len(self.messages),
+            'summary_tokens': estimate_tokens(self.summary) if self.summary else 0,
+            'compactions': self.compactions,
+            'compaction_time_s': self.compaction_time,
+            'dropped_messages': self.dropped_messages,
+        }
+
+async def respond(bus, session_id, history, turn):
+    segment_topic = f'/sessions/{session_id}/text_out/segment'
+    splitter = SentenceSplitter()
+    assistant_response = ''
+    print('AI: ', end='', flush=True)
+    try:
+        async for chunk in completions_create(history.payload()):
+            if not assistant_response: metrics().mark(session_id, 'llm_first_token')
+            print(chunk, end="")
+            assistant_response += chunk
+            for segment in splitter.feed(chunk):
+                await bus.publish(segment_topic, (turn, segment, False))
+        print('\n')
+        metrics().mark(session_id, 'llm_last_token')
+        if assistant_response.strip():
+            await bus.publish(segment_topic, (turn, splitter.flush(), True))
+            await bus.publish(f'/sessions/{session_id}/text_out', assistant_response)
+        return bool(assistant_response.strip())
+    except asyncio.CancelledError:
+        print('\n[ User interruption ]\n')
+        raise
+    finally:
+        # An interrupted reply is kept as far as it got, the user heard at most that much.
+        if assistant_response.strip(): history.append('assistant', assistant_response)
+
+async def interaction_handler(bus, session_id, history):
     text_in = bus.subscribe(f'/sessions/{session_id}/text_in')
+    vad = bus.subscribe(f'/sessions/{session_id}/vad') if VAD_ENABLED and BARGE_IN else None
+    played = bus.subscribe(f'/sessions/{session_id}/played')
+    interrupt_topic = f'/sessions/{session_id}/interrupt'
+    turn = 0
+    played_turn = 0
+    reply = None
 
-    async with aiohttp.ClientSession() as client:
-        client.headers['Authorization'] = f'Bearer {NVAPI_KEY}'
-        client.headers['Content-Type'] = 'application/json'
-
-        async def completions_create(messages):
-            payload = {
-                "model": "meta/llama3-8b-instruct",
-                "messages": messages,
-                "temperature": 0.5,
-                "top_p": 1,
-                "max_tokens": 128,
-                "stream": True,
-            }
-            try:
-                async with client.post('https://integrate.api.nvidia.com/v1/chat/completions', json=payload) as response:
-                    if response.status == 200:
-                        async for line in response.content:
-                            line = line.decode("utf-8").strip()
-                            if line.startswith('data:'): line = line[5:].strip()
-                            if line.startswith('[DONE]'): break
-                            if not line: continue
-                            try:
-                                chunk = json.loads(line)
-                                yield chunk
-                            except json.JSONDecodeError as e:
-                                print(f'LLM API Error: {e}')
-                                continue
-                    else:
-                        print(f'LLM API Error: Status code {response.status}')
-            except aiohttp.ClientError as e:
-                print(f'HTTP Error: {e}')
-
-        messages = [{'role':'system', 'content': SYSTEM_PROMPT}]
+    def busy():
+        # The reply is still streaming, or it said something that Streaming hasn't finished playing.
+        nonlocal played_turn
+        while not played.empty(): played_turn = max(played_turn, played.get_nowait())
+        if reply is None: return False
+        if not reply.done(): return True
+        return not reply.cancelled() and reply.exception() is None and reply.result() and played_turn < turn
 
+    async def interrupt(started):
+        # Every stage drops what it holds for turns up to this one, the LLM request is cancelled here.
+        nonlocal played_turn
+        played_turn = turn
+        await bus.publish(interrupt_topic, (turn, started))
+        if reply is not None and not reply.done():
+            reply.cancel()
+            await asyncio.gather(reply, return_exceptions=True)
+        metrics().interrupted(session_id, 'llm', started)
+
+    async def barge_in():
+        # The user starting to speak interrupts right away, without waiting for the transcript.
         while True:
-            while messages[-1]['role'] != 'user':
-                while True:
-                    text = await text_in.get()
-                    messages.append({'role': 'user', 'content': text})
-                    if text_in.empty(): break
-
-            print('User: ' + messages[-1]['content'])
-            print('AI: ', end='', flush=True)
-
-            assistant_response = ''
-            async for chunk in completions_create(messages):
-                if not text_in.empty():
-                    print('\n[ User interruption ]\n')
-                    break
-                if 'content' in chunk['choices'][0]['delta']:
-                    chunk = chunk['choices'][0]['delta']['content']
-                    print(chunk, end="")
-                    assistant_response += chunk
-            else:
-                print('\n')
+            if await vad.get() == 'start' and busy(): await interrupt(time.monotonic())
 
-            if assistant_response.strip():
-                await bus.publish(f'/sessions/{session_id}/text_out', assistant_response)
-                messages.append({'role': 'assistant', 'content': assistant_response})
-    
-class Interaction:
+    barge_in_task = asyncio.create_task(barge_in()) if vad is not None else None
+    try:
+        while True:
+            text = await text_in.get()
+            if busy(): await interrupt(time.monotonic())
+            history.append('user', text)
+            while not text_in.empty():
+                history.append('user', text_in.get_nowait())
+            print('User: ' + history[-1]['content'])
+            turn += 1
+            reply = asyncio.create_task(respond(bus, session_id, history, turn))
+    finally:
+        if barge_in_task is not None: barge_in_task.cancel()
+        if reply is not None: reply.cancel()
+
+class Interaction(SessionService):
     def __init__(self, bus):
-        self.bus = bus
-        self.session_new = bus.subscribe('/session_new')
-        self.handlers = {}
+        super().__init__(bus)
+        self.histories = {}
 
-    async def run(self):
-        while True:
-            session_id = await self.session_new.get()
-            self.handlers[session_id] = asyncio.create_task(interaction_handler(self.bus, session_id))
+    def handler(self, session_id):
+        history = self.histories[session_id] = ConversationHistory(SYSTEM_PROMPT)
+        metrics().history(session_id, history)
+        return interaction_handler(self.bus, session_id, history)
+
+    def stop(self, session_id):
+        history = self.histories.pop(session_id, None)
+        if history is not None and history.compactor is not None: history.compactor.cancel()
 
     async def shutdown(self):
-        self.bus.unsubscribe('/session_new', self.session_new)
-        await asyncio.gather(*self.handlers.values())
\ No newline at end of file
+        await super().shutdown()
+        await close_llm_client()
@@ -1,23 +1,45 @@
 import asyncio
 import riva.client
+import riva.client.proto.riva_asr_pb2 as rasr
+import riva.client.proto.riva_asr_pb2_grpc as rasr_srv
+import grpc
 import os
-import av
+import threading
 import numpy as np
 import time
+from services.common.audio import pcm_stage
+from services.common.vad import vad_stage, VAD_ENABLED, VAD_HANGOVER_MS
+from services.common.grpc_pool import channel_pool, nvcf_metadata
+from services.common.tts_cache import tts_cache, tts_cache_key
+from services.common.session import SessionService, background_task, cancel_tasks
+from services.common.metrics import metrics
 
-NVAPI_KEY = os.getenv('NVAPI_KEY')
+ASR_FUNCTION_ID = '1598d209-5e27-4d3c-8079-4751568b1081'
+TTS_FUNCTION_ID = '0149dedb-2be8-4195-b9a0-e57e0e14f972'
 
+ASR_MODE = os.getenv('ASR_MODE', 'aio') # 'aio' streams over grpc.aio on the event loop, 'thread' uses riva.client in a thread
 ASR_SAMPLE_RATE = 48000
 TTS_SAMPLE_RATE = 48000
+TTS_VOICE = 'English-US.Male-1'
+TTS_LANGUAGE = 'en-US'
+TTS_CACHE_WARM_FILE = os.getenv('TTS_CACHE_WARM_FILE') # phrases to synthesize into the cache at startup, one TTS segment per line
+TTS_STREAMING = os.getenv('TTS_STREAMING', '1') == '1' # speak each text_out/segment as the LLM streams instead of whole responses
 TTS_APPEND_SILENCE_MS = 400
+ASR_RETRY_CODES = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.ABORTED, grpc.StatusCode.INTERNAL)
+ASR_RETRY_DELAY_S = 0.5
+TTS_SILENCE = np.zeros(int(TTS_SAMPLE_RATE * TTS_APPEND_SILENCE_MS / 1000), dtype=np.int16)
 
-def riva_asr_streaming_response(chunks):
-    auth = riva.client.Auth(uri='grpc.nvcf.nvidia.com:443', use_ssl=True, metadata_args=[
-        ('function-id', '1598d209-5e27-4d3c-8079-4751568b1081'),
-        ('authorization', 'Bearer ' + NVAPI_KEY)
-    ])
-    service = riva.client.ASRService(auth)
-    config = riva.client.StreamingRecognitionConfig(config=riva.client.RecognitionConfig(
+class RivaAuth:
+    # riva.client services only use .channel and .get_auth_metadata(), so a pooled channel can stand in for riva.client.Auth.
+    def __init__(self, channel, function_id):
+        self.channel = channel
+        self.metadata = list(nvcf_metadata(function_id))
+
+    def get_auth_metadata(self):
+        return self.metadata
+
+def riva_asr_config():
+    return riva.client.StreamingRecognitionConfig(config=riva.client.RecognitionConfig(
         language_code = 'en-US',
         encoding = riva.client.AudioEncoding.LINEAR_PCM,
         sample_rate_hertz = ASR_SAMPLE_RATE,
@@ -25,121 +47,242 @@ def riva_asr_streaming_response(chunks):
         enable_automatic_punctuation = True,
         verbatim_transcripts = False,
     ), interim_results=False)
-    return service.streaming_response_generator(chunks, config)
-
-def riva_tts_service():
-    auth = riva.client.Auth(uri='grpc.nvcf.nvidia.com:443', use_ssl=True, metadata_args=[
-        ('function-id', '0149dedb-2be8-4195-b9a0-e57e0e14f972'),
-        ('authorization', 'Bearer ' + NVAPI_KEY)
-    ])
-    service = riva.client.SpeechSynthesisService(auth)
+
+def riva_asr_streaming_response(chunks, channel):
+    service = riva.client.ASRService(RivaAuth(channel, ASR_FUNCTION_ID))
+    return service.streaming_response_generator(chunks, riva_asr_config())
+
+def riva_asr_stream(channel):
+    stub = rasr_srv.RivaSpeechRecognitionStub(channel)
+    return stub.StreamingRecognize(metadata=nvcf_metadata(ASR_FUNCTION_ID))
+
+def riva_tts_service(channel):
+    service = riva.client.SpeechSynthesisService(RivaAuth(channel, TTS_FUNCTION_ID))
     return service
 
-async def resample_audio(audio, target_sample_rate=ASR_SAMPLE_RATE, chunk_size_ms=100):
-    chunk_size = int(2 * target_sample_rate * chunk_size_ms / 1000)
-    resampler = av.AudioResampler(
-        format='s16',
-        layout='mono',
-        rate=target_sample_rate,
+def tts_synthesize(tts_service, text):
+    return tts_service.synthesize_online(text, 
+        voice_name=TTS_VOICE,
+        language_code=TTS_LANGUAGE,
+        encoding=riva.client.AudioEncoding.LINEAR_PCM,
+        sample_rate_hz=TTS_SAMPLE_RATE
     )
-    buffer = bytearray()
-    async for frame in audio:
-        resampled_frames = resampler.resample(frame)
-        for frame in resampled_frames:
-            buffer.extend(bytes(frame.planes[0]))
-        while len(buffer) >= chunk_size:
-            chunk = buffer[:chunk_size]
-            yield bytes(chunk)
-            buffer = buffer[chunk_size:]
 
-async def asr_handler(bus, session_id):
-    audio_in = bus.subscribe(f'/sessions/{session_id}/audio_in')
-    
-    async def speech_frames_async():
-        while True:
-            frame = await audio_in.get()
-            yield frame
+def tts_cache_warm(tts_service, phrases):
+    cache = tts_cache()
+    for text in phrases:
+        key = tts_cache_key(text, TTS_VOICE, TTS_LANGUAGE, TTS_SAMPLE_RATE)
+        if key in cache: continue
+        pcm = np.concatenate([np.frombuffer(res.audio, dtype=np.int16) for res in tts_synthesize(tts_service, text)])
+        cache.put(key, pcm)
+
+def asr_retryable(e):
+    return isinstance(e, grpc.RpcError) and e.code() in ASR_RETRY_CODES
+
+async def publish_transcript(bus, session_id, transcript):
+    metrics().turn(session_id)
+    await bus.publish(f'/sessions/{session_id}/text_in', transcript)
 
+async def asr_thread_handler(bus, session_id, audio_in):
     loop = asyncio.get_running_loop()
+    closed = threading.Event()
     def speech_chunks():
-        chunks = resample_audio(speech_frames_async())
-        try:
-            while True:
-                result = asyncio.run_coroutine_threadsafe(anext(chunks), loop)
-                yield result.result()
-        except StopAsyncIteration:
-            pass
+        while not closed.is_set():
+            result = asyncio.run_coroutine_threadsafe(audio_in.get(), loop)
+            chunk = result.result()
+            if chunk is not None: yield chunk
     
-    def stream_results():
-        responses = riva_asr_streaming_response(speech_chunks())
+    def stream_results(channel):
+        responses = riva_asr_streaming_response(speech_chunks(), channel)
         for res in responses:
             if not res.results: continue
             for r in res.results:
                 if r.is_final:
                     transcript = r.alternatives[0].transcript
-                    asyncio.run_coroutine_threadsafe(bus.publish(f'/sessions/{session_id}/text_in', transcript), loop)
+                    asyncio.run_coroutine_threadsafe(publish_transcript(bus, session_id, transcript), loop)
 
-    await asyncio.create_task(asyncio.to_thread(stream_results))
+    try:
+        while True:
+            with channel_pool(aio=False).acquire() as lease:
+                try:
+                    await asyncio.create_task(asyncio.to_thread(stream_results, lease.channel))
+                except grpc.RpcError as e:
+                    if not asr_retryable(e): raise
+                    print(f'ASR Error: {e.code().name}, reopening the stream')
+            await asyncio.sleep(ASR_RETRY_DELAY_S)
+    finally:
+        # Ends the request generator so the thread and its Riva stream finish after a cancel.
+        closed.set()
+        audio_in.put_nowait(None)
+
+async def asr_utterance(bus, session_id, audio_in, channel, chunk):
+    # One StreamingRecognize call per utterance when VAD is on: the None end marker half-closes the
+    # stream so Riva finalizes right away.
+    async def write(stream, chunk):
+        await stream.write(rasr.StreamingRecognizeRequest(streaming_config=riva_asr_config()))
+        while chunk is not None:
+            await stream.write(rasr.StreamingRecognizeRequest(audio_content=chunk))
+            chunk = await audio_in.get()
+        metrics().speech_end(session_id, VAD_HANGOVER_MS)
+        await stream.done_writing()
+
+    stream = riva_asr_stream(channel)
+    writer = asyncio.create_task(write(stream, chunk))
+    try:
+        while True:
+            res = await stream.read()
+            if res == grpc.aio.EOF: break
+            for r in res.results:
+                if r.is_final:
+                    transcript = r.alternatives[0].transcript
+                    await publish_transcript(bus, session_id, transcript)
+    finally:
+        writer.cancel()
+        stream.cancel()
+
+async def asr_stream_handler(bus, session_id, audio_in):
+    # A transient gRPC error costs at most the current utterance: the lease is returned, so the pool can
+    # retire a failed channel, and the next utterance opens a fresh stream.
+    while True:
+        with channel_pool().acquire() as lease:
+            try:
+                while True:
+                    chunk = await audio_in.get()
+                    if chunk is not None: await asr_utterance(bus, session_id, audio_in, lease.channel, chunk)
+            except grpc.aio.AioRpcError as e:
+                if not asr_retryable(e): raise
+                print(f'ASR Error: {e.code().name}, reopening the stream')
+        await asyncio.sleep(ASR_RETRY_DELAY_S)
+
+async def asr_handler(bus, session_id):
+    if VAD_ENABLED: audio_in = bus.subscribe(vad_stage(bus, session_id, ASR_SAMPLE_RATE))
+    else: audio_in = bus.subscribe(pcm_stage(bus, f'/sessions/{session_id}/audio_in', ASR_SAMPLE_RATE))
+    if ASR_MODE == 'thread': await asr_thread_handler(bus, session_id, audio_in)
+    else: await asr_stream_handler(bus, session_id, audio_in)
 
 async def tts_handler(bus, session_id):
-    tts_service = riva_tts_service()
+    with channel_pool(aio=False).acquire() as lease:
+        await tts_stream_handler(bus, session_id, riva_tts_service(lease.channel))
+
+class TtsTurn:
+    # One response being synthesized: its segments, the Riva calls in flight and the task feeding them.
+    def __init__(self, turn):
+        self.turn = turn
+        self.segments = asyncio.Queue()
+        self.interrupt = threading.Event()
+        self.calls = []
+        self.worker = None
 
+    def stop(self):
+        # Cancelling the calls aborts synthesis inside the worker thread instead of waiting for the next chunk.
+        self.interrupt.set()
+        for call in list(self.calls):
+            call.cancel()
+        if self.worker is not None: self.worker.cancel()
+
+async def tts_stream_handler(bus, session_id, tts_service):
     loop = asyncio.get_running_loop()
-    def stream_results(text, interrupt, audio_id):
-        results = tts_service.synthesize_online(text, 
-            voice_name='English-US.Male-1',
-            language_code='en-US',
-            encoding=riva.client.AudioEncoding.LINEAR_PCM,
-            sample_rate_hz=TTS_SAMPLE_RATE
-        )
-
-        async def publish(frame):
-            await bus.publish(f'/sessions/{session_id}/speech_out', frame)
-            await bus.publish(f'/sessions/{session_id}/speech_out/id', audio_id)
-
-        pts = 0
-        for res in results:
-            if interrupt.is_set(): break
-            arr = np.frombuffer(res.audio, dtype=np.int16)
-            frame = av.AudioFrame.from_ndarray(arr.reshape((1, -1)), format='s16', layout='mono')
-            frame.pts = pts
-            frame.sample_rate = TTS_SAMPLE_RATE
-            pts += frame.samples
-            future = asyncio.run_coroutine_threadsafe(publish(frame), loop)
-            future.result()
+    def stream_results(text, current, final=True):
+        async def publish(pcm):
+            if current.interrupt.is_set(): return
+            metrics().mark(session_id, 'tts_first_chunk')
+            await bus.publish(f'/sessions/{session_id}/speech_out', pcm)
+            await bus.publish(f'/sessions/{session_id}/speech_out/id', current.turn)
+
+        if text:
+            key = tts_cache_key(text, TTS_VOICE, TTS_LANGUAGE, TTS_SAMPLE_RATE)
+            cached = tts_cache().get(key)
+            if cached is not None:
+                future = asyncio.run_coroutine_threadsafe(publish(cached), loop)
+                future.result()
+            else:
+                parts = []
+                responses = tts_synthesize(tts_service, text)
+                current.calls.append(responses)
+                if current.interrupt.is_set(): responses.cancel()
+                try:
+                    for res in responses:
+                        pcm = np.frombuffer(res.audio, dtype=np.int16)
+                        parts.append(pcm)
+                        future = asyncio.run_coroutine_threadsafe(publish(pcm), loop)
+                        future.result()
+                except grpc.RpcError:
+                    if not current.interrupt.is_set(): raise
+                    return
+                finally:
+                    current.calls.remove(responses)
+                if parts: tts_cache().put(key, np.concatenate(parts))
 
         # silence
-        silent_samples = int(TTS_SAMPLE_RATE * TTS_APPEND_SILENCE_MS / 1000)
-        frame = av.AudioFrame.from_ndarray(np.zeros((1, silent_samples), dtype=np.int16), format='s16', layout='mono')
-        frame.pts = pts
-        frame.sample_rate = TTS_SAMPLE_RATE
-        future = asyncio.run_coroutine_threadsafe(publish(frame), loop)
-        future.result()
-    
-    audio_id = 0
-    text_out = bus.subscribe(f'/sessions/{session_id}/text_out')
-    interrupt = None
-    while True:
-        text = await text_out.get()
-        if interrupt is not None: interrupt.set()
-        audio_id += 1
-        interrupt = asyncio.Event()
-        asyncio.create_task(asyncio.to_thread(lambda: stream_results(text, interrupt, audio_id)))
+        if final and not current.interrupt.is_set():
+            future = asyncio.run_coroutine_threadsafe(publish(TTS_SILENCE), loop)
+            future.result()
+
+    async def turn_handler(current):
+        # Segments of one turn are synthesized in order under one audio_id (the turn), so playback stays
+        # gapless. Without TTS_STREAMING the whole response is collected and synthesized at once.
+        final = False
+        while not final and not current.interrupt.is_set():
+            text, final = await current.segments.get()
+            if not TTS_STREAMING:
+                texts = [text]
+                while not final:
+                    text, final = await current.segments.get()
+                    texts.append(text)
+                text = ' '.join(text for text in texts if text)
+            await asyncio.to_thread(stream_results, text, current, final)
+
+    interrupted_turn = 0
+    current = None
+
+    async def interrupt_handler(interrupts):
+        nonlocal interrupted_turn
+        while True:
+            turn, started = await interrupts.get()
+            interrupted_turn = max(interrupted_turn, turn)
+            if current is not None and current.turn <= interrupted_turn: current.stop()
+            metrics().interrupted(session_id, 'tts', started)
+
+    text_segments = bus.subscribe(f'/sessions/{session_id}/text_out/segment')
+    interrupts = asyncio.create_task(interrupt_handler(bus.subscribe(f'/sessions/{session_id}/interrupt')))
+    try:
+        while True:
+            turn, text, final = await text_segments.get()
+            if turn <= interrupted_turn: continue
+            if current is None or turn != current.turn:
+                if current is not None: current.stop()
+                current = TtsTurn(turn)
+                current.worker = asyncio.create_task(turn_handler(current))
+            current.segments.put_nowait((text, final))
+    finally:
+        interrupts.cancel()
+        if current is not None: current.stop()
 
 async def speech_handler(bus, session_id):
-    await asyncio.gather(asr_handler(bus, session_id), tts_handler(bus, session_id))
+    # A failing half cancels the other, so no TTS task, lease or subscription outlives the session task.
+    async with asyncio.TaskGroup() as tasks:
+        tasks.create_task(asr_handler(bus, session_id))
+        tasks.create_task(tts_handler(bus, session_id))
 
-class Speech:
+class Speech(SessionService):
     def __init__(self, bus):
-        self.bus = bus
-        self.session_new = bus.subscribe('/session_new')
-        self.handlers = {}
+        super().__init__(bus)
+        self.warm = None
 
     async def run(self):
-        while True:
-            session_id = await self.session_new.get()
-            self.handlers[session_id] = asyncio.create_task(speech_handler(self.bus, session_id))
+        if TTS_CACHE_WARM_FILE: self.warm = background_task(self.warm_tts_cache(TTS_CACHE_WARM_FILE), 'tts_cache.warm')
+        await super().run()
 
     async def shutdown(self):
-        self.bus.unsubscribe('/session_new', self.session_new)
-        await asyncio.gather(*self.handlers.values())
\ No newline at end of file
+        await cancel_tasks([self.warm])
+        await super().shutdown()
+
+    def handler(self, session_id):
+        return speech_handler(self.bus, session_id)
+
+    async def warm_tts_cache(self, path):
+        with open(path) as f:
+            phrases = [line.strip() for line in f if line.strip()]
+        with channel_pool(aio=False).acquire() as lease:
+            await asyncio.to_thread(tts_cache_warm, riva_tts_service(lease.channel), phrases)
+        print(f'[ TTS cache warmed with {len(phrases)} phrases: {tts_cache().stats()} ]')
@@ -2,69 +2,240 @@ import aiohttp.web
 from aiortc import RTCPeerConnection, RTCSessionDescription
 from aiortc import AudioStreamTrack
 from aiortc.contrib.media import MediaRecorder
-from collections import deque
+from aiortc.mediastreams import MediaStreamError
 import asyncio
+import os
+import time
+from collections import deque
 import numpy as np
 import av
 import json
-
-# TODO Priyank: need to rework audio + animation streaming for synchronization.
+import struct
+from services.common.session import SessionRegistry, background_task, cancel_tasks
+from services.common.metrics import metrics
+from services.common.tts_cache import tts_cache
+from services.common.assets import assets
 
 AUDIO_OUT_CHUNK_SIZE_MS = 20
-AUDIO_OUT_DELAY_MS = 400 
+AUDIO_OUT_DELAY_MS = 400 # until the session's A2F latency has been measured
+AUDIO_OUT_MIN_DELAY_MS = 100
+AUDIO_OUT_MAX_DELAY_MS = 1000
+AUDIO_OUT_MAX_LATE_MS = 100
+AUDIO_OUT_TIMELINE_FRAMES = 500 # played frames remembered for mapping anim pts back to playout times
 AUDIO_OUT_SAMPLE_RATE = 48000 # TODO Priyank: this needs to match what webrtc peer expects
+AUDIO_OUT_FRAME_POOL = 256
+
+ANIM_OUT_BATCH_FRAMES = 8
+ANIM_OUT_QUANTIZE = False
+ANIM_OUT_LEAD_MS = 60 # anim is sent this long before its audio leaves the delay line
+ANIM_OUT_LATENCY_WINDOW = 50
+ANIM_OUT_LATENCY_PERCENTILE = 95
+ANIM_FORMAT_VERSION = 2
+ANIM_FLAG_INT16 = 1
+ANIM_HEADER = struct.Struct('<BBHHxx')
+
+STREAMING_HOST = os.getenv('STREAMING_HOST', '0.0.0.0')
+STREAMING_PORT = int(os.getenv('STREAMING_PORT', '5000'))
+
+VIDEO_IN_FPS = float(os.getenv('VIDEO_IN_FPS', '1')) # sampling rate of frames offered to video_in subscribers
+VIDEO_IN_HASH_DISTANCE = 6 # bits out of 64 that must differ from the last published frame
+
+class AudioFramer:
+    # TTS PCM goes into a preallocated int16 ring, fixed-size frames come out of a rotating pool of
+    # preallocated av.AudioFrames. The pool must outlive every frame a consumer can still hold
+    # (bounded bus queues plus the delay line), so it is sized well above those bounds.
+    def __init__(self, frame_size, sample_rate, capacity_s=10, pool_size=AUDIO_OUT_FRAME_POOL):
+        self.frame_size = frame_size
+        self.ring = np.zeros(capacity_s * sample_rate, dtype=np.int16)
+        self.start = 0
+        self.size = 0
+        self.pool = []
+        for _ in range(pool_size):
+            frame = av.AudioFrame(format='s16', layout='mono', samples=frame_size)
+            frame.sample_rate = sample_rate
+            self.pool.append((frame, np.frombuffer(frame.planes[0], dtype=np.int16)[:frame_size]))
+        self.next = 0
+
+    def frames(self):
+        return self.size // self.frame_size
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+
+    def write(self, pcm):
+        capacity = len(self.ring)
+        if self.size + len(pcm) > capacity:
+            ring = np.zeros(max(2 * capacity, self.size + len(pcm)), dtype=np.int16)
+            ring[:self.size] = np.roll(self.ring, -self.start)[:self.size]
+            self.ring, self.start, capacity = ring, 0, len(ring)
+        end = (self.start + self.size) % capacity
+        first = min(len(pcm), capacity - end)
+        self.ring[end:end + first] = pcm[:first]
+        self.ring[:len(pcm) - first] = pcm[first:]
+        self.size += len(pcm)
+
+    def pop(self):
+        frame, view = self.pool[self.next]
+        self.next = (self.next + 1) % len(self.pool)
+        capacity = len(self.ring)
+        first = min(self.frame_size, capacity - self.start)
+        view[:first] = self.ring[self.start:self.start + first]
+        view[first:] = self.ring[:self.frame_size - first]
+        self.start = (self.start + self.frame_size) % capacity
+        self.size -= self.frame_size
+        return frame
+
+class PlayoutScheduler:
+    # Paces audio_out against a monotonic clock (slot n plays at start + n * frame duration, so no drift
+    # accumulates) and feeds audio_out/delayed from a single delay line instead of a task per frame.
+    def __init__(self, bus, session_id, sample_rate, delay_ms=AUDIO_OUT_DELAY_MS):
+        self.bus = bus
+        self.sample_rate = sample_rate
+        self.topic = f'/sessions/{session_id}/audio_out'
+        self.topic_delayed = f'/sessions/{session_id}/audio_out/delayed'
+        self.frame_duration = AUDIO_OUT_CHUNK_SIZE_MS / 1000
+        self.frame_samples = int(sample_rate * AUDIO_OUT_CHUNK_SIZE_MS / 1000)
+        self.delay = self.target_delay = delay_ms / 1000
+        self.delay_line = deque()
+        self.timeline = deque(maxlen=AUDIO_OUT_TIMELINE_FRAMES)
+        self.deadline = None
+        self.underruns = 0
+        self.late_frames = 0
+        self.dropped_frames = 0
 
-def chunk_audio_frame(frame, chunk_size, sample_rate):
-    raw_audio = bytes(frame.planes[0])
-    total_samples = len(raw_audio) // 2  # since each sample is 2 bytes (16-bit PCM)
-    chunks = []
-    for i in range(0, total_samples, chunk_size):
-        chunk_data = raw_audio[i * 2 : (i + chunk_size) * 2]
-        audio_array = np.frombuffer(chunk_data, dtype=np.int16).reshape((1, -1))
-        chunk_frame = av.AudioFrame.from_ndarray(audio_array, format='s16', layout='mono')
-        chunk_frame.pts = frame.pts + i
-        chunk_frame.sample_rate = sample_rate
-        chunks.append(chunk_frame)
-    return chunks
-
-def silent_frame(duration, pts, sample_rate):
-    frame_size = int(duration * sample_rate)
-    frame = av.AudioFrame.from_ndarray(np.zeros((1, frame_size), dtype=np.int16), format='s16', layout='mono')
-    frame.pts = pts
-    frame.sample_rate = sample_rate
-    return frame
-
-async def audio_out_handler(bus, session_id, sample_rate):
-    loop = asyncio.get_event_loop()
+    def stats(self):
+        return {
+            'underruns': self.underruns,
+            'late_frames': self.late_frames,
+            'dropped_frames': self.dropped_frames,
+            'delay_line': len(self.delay_line),
+            'delay_ms': 1000 * self.delay,
+        }
+
+    def set_delay(self, delay_ms):
+        # Takes effect once the delay line has drained, changing it mid-utterance would cut or stretch audio.
+        self.target_delay = min(max(delay_ms, AUDIO_OUT_MIN_DELAY_MS), AUDIO_OUT_MAX_DELAY_MS) / 1000
+
+    def flush(self):
+        # Drops what is still in the delay line and what the WebRTC track has not picked up yet.
+        self.delay_line.clear()
+        self.deadline = None
+        for queue in self.bus.subscribers.get(self.topic_delayed, ()):
+            queue.drain()
+
+    def next_pts(self):
+        return self.timeline[-1][0] + self.frame_samples if self.timeline else 0
+
+    def lookup(self, pts):
+        # (published, released) monotonic times of the played frame containing pts, pts advance by one frame per slot.
+        if not self.timeline: return None
+        index = (pts - self.timeline[0][0]) // self.frame_samples
+        if 0 <= index < len(self.timeline): return self.timeline[index][1:]
+
+    async def release(self):
+        now = time.monotonic()
+        while self.delay_line and self.delay_line[0][0] <= now:
+            _, frame = self.delay_line.popleft()
+            await self.bus.publish(self.topic_delayed, frame)
+
+    async def wait(self, aw, drained=None):
+        # Called when the output buffer ran dry, keeps the delay line flowing until audio arrives and
+        # awaits drained() if it empties first.
+        self.deadline = None
+        task = asyncio.ensure_future(aw)
+        try:
+            while self.delay_line and not task.done():
+                await asyncio.wait((task,), timeout=max(0, self.delay_line[0][0] - time.monotonic()))
+                await self.release()
+            if drained is not None and not task.done(): await drained()
+            return await task
+        finally:
+            task.cancel()
+
+    def behind(self):
+        # Frames more than AUDIO_OUT_MAX_LATE_MS behind their slot are dropped to catch up.
+        now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        elif now - self.deadline > AUDIO_OUT_MAX_LATE_MS / 1000:
+            self.dropped_frames += 1
+            self.deadline += self.frame_duration
+            return True
+        elif now - self.deadline > self.frame_duration / 2:
+            self.late_frames += 1
+        return False
+
+    async def play(self, frame):
+        if not self.delay_line: self.delay = self.target_delay
+        await self.bus.publish(self.topic, frame)
+        released = self.deadline + self.delay
+        self.timeline.append((frame.pts, time.monotonic(), released))
+        self.delay_line.append((released, frame))
+        await self.release()
+        self.deadline += self.frame_duration
+        await asyncio.sleep(max(0, self.deadline - time.monotonic()))
+
+async def audio_out_handler(bus, session_id, playout):
     queue = bus.subscribe(f'/sessions/{session_id}/speech_out')
     id_queue = bus.subscribe(f'/sessions/{session_id}/speech_out/id')
+    interrupts = bus.subscribe(f'/sessions/{session_id}/interrupt')
 
-    out_topic = f'/sessions/{session_id}/audio_out'
-    out_topic_delayed = f'/sessions/{session_id}/audio_out/delayed'
-    async def bus_publish_delayed(topic, frame, duration):
-        await asyncio.sleep(duration)
-        await bus.publish(topic, frame)
-
-    chunk_size = int(sample_rate * AUDIO_OUT_CHUNK_SIZE_MS / 1000)
-    frames = deque()
+    chunk_size = int(playout.sample_rate * AUDIO_OUT_CHUNK_SIZE_MS / 1000)
+    framer = AudioFramer(chunk_size, playout.sample_rate)
     last_audio_id = 0
+    interrupted_id = 0
+    playing_id = 0
     next_pts = 0
-    while True:
-        while not queue.empty() or len(frames) == 0:
-            frame = await queue.get()
-            audio_id = await id_queue.get() 
-            if audio_id > last_audio_id:
-                frames.clear()
-                last_audio_id = audio_id
-            if len(frames) > 0: frame.pts = frames[-1].pts + frames[-1].samples
-            else: frame.pts = next_pts
-            frames.extend(chunk_audio_frame(frame, chunk_size, sample_rate))
-        frame = frames.popleft()
-        await bus.publish(out_topic, frame)
-        loop.create_task(bus_publish_delayed(out_topic_delayed, frame, duration=AUDIO_OUT_DELAY_MS/1000))
-        next_pts = frame.pts + frame.samples
-        duration = frame.samples / sample_rate
-        await asyncio.sleep(duration)
+    first_frame = False
+
+    async def drained():
+        # Tells Interaction a turn's audio has all been handed to the track, barge-in has nothing to stop.
+        nonlocal playing_id
+        if playing_id:
+            await bus.publish(f'/sessions/{session_id}/played', playing_id)
+            playing_id = 0
+
+    async def interrupt_handler():
+        # Audio ids are turns, so speech_out of an interrupted turn arriving later is dropped too. pts keep
+        # advancing, the encoder and the anim timeline must never go backwards.
+        nonlocal interrupted_id, playing_id
+        while True:
+            turn, started = await interrupts.get()
+            interrupted_id = max(interrupted_id, turn)
+            playing_id = 0
+            queue.drain()
+            id_queue.drain()
+            framer.clear()
+            playout.flush()
+            metrics().interrupted(session_id, 'audio', started)
+
+    interrupting = asyncio.create_task(interrupt_handler())
+    try:
+        while True:
+            while not queue.empty() or framer.frames() == 0:
+                starved = framer.frames() == 0 and playout.deadline is not None
+                pcm = await (queue.get() if not queue.empty() else playout.wait(queue.get(), drained))
+                audio_id = await id_queue.get()
+                if audio_id <= interrupted_id: continue
+                playing_id = audio_id
+                if audio_id > last_audio_id:
+                    framer.clear()
+                    last_audio_id = audio_id
+                    first_frame = True
+                elif starved:
+                    playout.underruns += 1
+                framer.write(pcm)
+            frame = framer.pop()
+            if playout.behind(): continue
+            frame.pts = next_pts
+            next_pts += frame.samples
+            await playout.play(frame)
+            if first_frame:
+                metrics().mark(session_id, 'audio_out')
+                first_frame = False
+    finally:
+        interrupting.cancel()
 
 class BusAudioOut(AudioStreamTrack):
     sample_rate = 48000
@@ -82,75 +253,251 @@ class BusAudioOut(AudioStreamTrack):
         super().stop()
         self.bus.unsubscribe(f'/sessions/{self.session_id}/audio_out/delayed', self.queue)
 
-async def channel_handler(bus, session_id, channel):
+def encode_anim(pts, values, quantize=ANIM_OUT_QUANTIZE):
+    # Binary anim batch: <version u8, flags u8, frame count u16, name count u16, pad u16>, then
+    # int64 pts[count] on the audio_out timeline, then float32 (or int16 scaled by 32767) values[count][names].
+    count, names = values.shape
+    flags = ANIM_FLAG_INT16 if quantize else 0
+    if quantize: values = np.round(np.clip(values, -1, 1) * 32767).astype('<i2')
+    else: values = values.astype('<f4', copy=False)
+    header = ANIM_HEADER.pack(ANIM_FORMAT_VERSION, flags, count, names)
+    return b''.join((header, np.asarray(pts, dtype='<i8').tobytes(), values.tobytes()))
+
+class AnimSync:
+    # Aligns anim with the delayed audio: A2F latency is how long after a frame's audio was played its
+    # animation arrives, the playout delay follows a high percentile of it, and each batch is held until
+    # ANIM_OUT_LEAD_MS before its audio is released so the client only needs a small jitter buffer.
+    def __init__(self, playout):
+        self.playout = playout
+        self.latencies = deque(maxlen=ANIM_OUT_LATENCY_WINDOW)
+        self.late_chunks = 0
+        self.floor = 0
+
+    def interrupt(self):
+        # Anim for audio played before the interruption, still in A2F or held here, is stale.
+        self.floor = self.playout.next_pts()
+
+    def stale(self, pts):
+        return pts[-1] < self.floor
+
+    def pts(self, chunk):
+        return np.rint(chunk.time_codes * self.playout.sample_rate).astype(np.int64)
+
+    def arrived(self, pts):
+        # Returns when the first frame's audio leaves the delay line, None if it is no longer known.
+        first, last = self.playout.lookup(pts[0]), self.playout.lookup(pts[-1])
+        if last is not None:
+            self.latencies.append(time.monotonic() - last[0])
+            self.playout.set_delay(np.percentile(self.latencies, ANIM_OUT_LATENCY_PERCENTILE) * 1000 + ANIM_OUT_LEAD_MS)
+        return first[1] if first is not None else None
+
+    async def hold(self, released):
+        if released is None: return
+        wait = released - ANIM_OUT_LEAD_MS / 1000 - time.monotonic()
+        if wait > 0: await asyncio.sleep(wait)
+        else: self.late_chunks += 1
+
+    def stats(self):
+        return {
+            'a2f_latency_ms': 1000 * float(np.percentile(self.latencies, ANIM_OUT_LATENCY_PERCENTILE)) if self.latencies else None,
+            'late_chunks': self.late_chunks,
+        }
+
+async def anim_channel_handler(queue, channel, sync):
+    def send(chunks):
+        if len(chunks) == 1: pts, values = chunks[0].pts, chunks[0].values
+        else:
+            pts = np.concatenate([chunk.pts for chunk in chunks])
+            values = np.concatenate([chunk.values for chunk in chunks])
+        channel.send(encode_anim(pts, values))
+
+    header = {'kind': 'anim_header', 'sample_rate': sync.playout.sample_rate, 'lead_ms': ANIM_OUT_LEAD_MS}
+    names = None
+    while True:
+        chunk = await queue.get()
+        chunk.pts = sync.pts(chunk)
+        if sync.stale(chunk.pts): continue
+        await sync.hold(sync.arrived(chunk.pts))
+        if sync.stale(chunk.pts): continue
+        batch = [chunk]
+        frames = len(batch[0])
+        while frames < ANIM_OUT_BATCH_FRAMES and not queue.empty():
+            chunk = queue.get_nowait()
+            chunk.pts = sync.pts(chunk)
+            if sync.stale(chunk.pts): continue
+            sync.arrived(chunk.pts)
+            batch.append(chunk)
+            frames += len(chunk)
+        chunks = []
+        for chunk in batch:
+            if chunk.names is not names and chunk.names != names:
+                if chunks: send(chunks)
+                chunks = []
+                names = chunk.names
+                channel.send(json.dumps(dict(header, message=names)))
+            chunks.append(chunk)
+        send(chunks)
+
+def video_hash(frame):
+    # 64-bit difference hash from a 9x8 grayscale thumbnail, so only a tiny scaled copy is ever converted.
+    thumbnail = frame.reformat(width=9, height=8, format='gray').to_ndarray()
+    return int.from_bytes(np.packbits(thumbnail[:, 1:] > thumbnail[:, :-1]).tobytes(), 'big')
+
+async def video_in_handler(bus, session_id, track):
+    # Frames stay as received (no conversion) and are only sampled, hashed and published while someone
+    # subscribes to video_in. aiortc decodes on its own thread before recv(), so frames are still drained.
+    topic = f'/sessions/{session_id}/video_in'
+    interval = 1 / VIDEO_IN_FPS
+    next_sample = 0
+    last_hash = None
+    while True:
+        frame = await track.recv()
+        if not bus.has_subscribers(topic):
+            last_hash = None
+            continue
+        now = time.monotonic()
+        if now < next_sample: continue
+        next_sample = now + interval
+        frame_hash = video_hash(frame)
+        if last_hash is not None and bin(frame_hash ^ last_hash).count('1') < VIDEO_IN_HASH_DISTANCE: continue
+        last_hash = frame_hash
+        await bus.publish(topic, frame)
+
+async def channel_handler(bus, session_id, channel, sync):
     text_in = bus.subscribe(f'/sessions/{session_id}/text_in')
     text_out = bus.subscribe(f'/sessions/{session_id}/text_out')
     anim_out = bus.subscribe(f'/sessions/{session_id}/anim_out')
+    interrupts = bus.subscribe(f'/sessions/{session_id}/interrupt')
     
     async def handle(queue, func):
         while True:
             item = await queue.get()
             func(item)
+
+    def interrupt(message):
+        turn, started = message
+        sync.interrupt()
+        anim_out.drain()
+        channel.send(json.dumps({'kind': 'interrupt'}))
+        metrics().interrupted(session_id, 'anim', started)
     handlers = [
         handle(text_in, lambda text: channel.send(json.dumps({'kind': 'log', 'message': 'User: ' + text}))),
         handle(text_out, lambda text: channel.send(json.dumps({'kind': 'log', 'message': 'Assistant: ' + text}))),
-        handle(anim_out, lambda anim: channel.send(json.dumps({'kind': 'anim', 'message': anim})))
+        anim_channel_handler(anim_out, channel, sync),
+        handle(interrupts, interrupt),
     ]
     await asyncio.gather(*handlers)
 
 class Streaming:
-    def __init__(self, bus):
+    def __init__(self, bus, host=STREAMING_HOST, port=STREAMING_PORT, serve_assets=True):
+        # Workers behind the dispatcher leave the page and its assets to it.
         self.bus = bus
+        self.serve_assets = serve_assets
+        self.host = host
+        self.port = port
         self.pcs = {}
         self.channel_handlers = {}
         self.audio_handlers = {}
+        self.playouts = {}
+        self.anim_syncs = {}
+        self.background = []
+        self.sessions = SessionRegistry(bus)
         app = aiohttp.web.Application()
-        app.router.add_get('/', self.index)
+        if serve_assets: app.router.add_get('/', assets().index)
         app.router.add_post('/offer', self.offer)
-        app.router.add_static('/assets/', path='static/')
+        app.router.add_get('/sessions', self.session_stats)
+        app.router.add_get('/load', self.load)
+        app.router.add_get('/metrics', self.prometheus_metrics)
+        if serve_assets: app.router.add_get('/assets/{name}', assets().asset)
         self.runner = aiohttp.web.AppRunner(app)
 
     async def run(self):
         await self.runner.setup()
-        site = aiohttp.web.TCPSite(self.runner, '0.0.0.0', 5000)
+        site = aiohttp.web.TCPSite(self.runner, self.host, self.port)
         await site.start()
-        print("[ Serving on 0.0.0.0:5000 ]")
+        print(f"[ Serving on {self.host}:{self.port} ]")
+        self.background = [background_task(metrics().monitor_loop(), 'metrics.monitor_loop')]
+        if self.serve_assets: self.background.append(background_task(asyncio.to_thread(assets().compress), 'assets.compress'))
         while True: await asyncio.sleep(999)
     
     async def shutdown(self):
-        tasks = [pc.close() for pc in self.pcs.values()]
+        tasks = [self.end_session(session_id) for session_id in list(self.pcs)]
         await asyncio.gather(*tasks)
+        await cancel_tasks(self.background)
         await self.runner.cleanup()
 
-    async def index(self, request):
-        return aiohttp.web.FileResponse('static/index.html')
+    async def end_session(self, session_id):
+        pc = self.pcs.pop(session_id, None)
+        if pc is None: return
+        tasks = [self.audio_handlers.pop(session_id, None), self.channel_handlers.pop(session_id, None)]
+        self.playouts.pop(session_id, None)
+        self.anim_syncs.pop(session_id, None)
+        await pc.close()
+        await self.sessions.close(session_id, tasks)
+        metrics().close(session_id)
+
+    async def session_stats(self, request):
+        return aiohttp.web.json_response(self.sessions.stats())
+
+    async def prometheus_metrics(self, request):
+        return aiohttp.web.Response(text=metrics().render(self.bus, self.playouts, tts_cache().stats(), self.anim_syncs), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+    async def load(self, request):
+        queues = [queue for queues in self.bus.subscribers.values() for queue in queues]
+        return aiohttp.web.json_response({
+            'pid': os.getpid(),
+            'sessions': len(self.sessions.live),
+            'opened': self.sessions.opened,
+            'tasks': len(asyncio.all_tasks()),
+            'queues': len(queues),
+            'queued': sum(queue.qsize() for queue in queues),
+            'underruns': sum(playout.underruns for playout in self.playouts.values()),
+            'late_frames': sum(playout.late_frames for playout in self.playouts.values()),
+            'dropped_frames': sum(playout.dropped_frames for playout in self.playouts.values()),
+        })
 
     async def offer(self, request):
         params = await request.json()
         session_id = params.get('session_id')
+        offer = RTCSessionDescription(sdp=params['sdp']['sdp'], type=params['sdp']['type'])
+        if session_id in self.pcs: await self.end_session(session_id)
         pc = self.pcs[session_id] = RTCPeerConnection()
+        self.sessions.open(session_id)
         pc.addTrack(BusAudioOut(self.bus, session_id))
-        self.audio_handlers[session_id] = asyncio.create_task(audio_out_handler(self.bus, session_id, sample_rate=AUDIO_OUT_SAMPLE_RATE))
+        playout = self.playouts[session_id] = PlayoutScheduler(self.bus, session_id, sample_rate=AUDIO_OUT_SAMPLE_RATE)
+        self.audio_handlers[session_id] = asyncio.create_task(audio_out_handler(self.bus, session_id, playout))
         await self.bus.publish('/session_new', session_id)
 
+        @pc.on('connectionstatechange')
+        async def on_connectionstatechange():
+            if pc.connectionState in ('failed', 'closed') and self.pcs.get(session_id) is pc:
+                await self.end_session(session_id)
+
         @pc.on('track')
         async def on_track(track):
             pc.addTrack(track)
-            if track.kind == 'video':
-                while True:
-                    frame = await track.recv()
-                    await self.bus.publish(f'/sessions/{session_id}/video_in', frame)
-            if track.kind == 'audio':
-                while True:
-                    frame = await track.recv()
-                    await self.bus.publish(f'/sessions/{session_id}/audio_in', frame)
+            try:
+                if track.kind == 'video':
+                    await video_in_handler(self.bus, session_id, track)
+                if track.kind == 'audio':
+                    while True:
+                        frame = await track.recv()
+                        metrics().audio_in(session_id)
+                        await self.bus.publish(f'/sessions/{session_id}/audio_in', frame)
+            except MediaStreamError:
+                pass
 
         @pc.on("datachannel")
         def on_datachannel(channel):
-            self.channel_handlers[session_id] = asyncio.create_task(channel_handler(self.bus, session_id, channel))
+            sync = self.anim_syncs[session_id] = AnimSync(playout)
+            self.channel_handlers[session_id] = asyncio.create_task(channel_handler(self.bus, session_id, channel, sync))
 
-        offer = RTCSessionDescription(sdp=params['sdp']['sdp'], type=params['sdp']['type'])
-        await pc.setRemoteDescription(offer)
-        answer = await pc.createAnswer()
-        await pc.setLocalDescription(answer)
+        try:
+            await pc.setRemoteDescription(offer)
+            answer = await pc.createAnswer()
+            await pc.setLocalDescription(answer)
+        except BaseException:
+            # A bad offer, or the client going away mid-negotiation, must not leave the session behind.
+            if self.pcs.get(session_id) is pc: await self.end_session(session_id)
+            raise
         return aiohttp.web.json_response({"sdp": pc.localDescription.sdp, "type": pc.localDescription.type})
\ No newline at end of file
@@ -0,0 +1,70 @@
+import asyncio
+import grpc
+import riva.client.proto.riva_tts_pb2 as rtts
+import riva.client.proto.riva_tts_pb2_grpc as rtts_srv
+from bench.fakes import FakeTts
+from services.common.grpc_pool import ChannelPool, UNHEALTHY
+
+# ChannelPool against the local Riva TTS stand-in from bench/fakes.py.
+
+async def start_server():
+    server = grpc.aio.server()
+    rtts_srv.add_RivaSpeechSynthesisServicer_to_server(FakeTts(latency_ms=0), server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    await server.start()
+    return server, f'127.0.0.1:{port}'
+
+async def synthesize(lease):
+    stub = rtts_srv.RivaSpeechSynthesisStub(lease.channel)
+    request = rtts.SynthesizeSpeechRequest(text='hello', sample_rate_hz=16000)
+    return [response async for response in stub.SynthesizeOnline(request)]
+
+async def wait_unhealthy(channel, timeout=10):
+    async def wait():
+        state = channel.get_state(try_to_connect=True)
+        while state not in UNHEALTHY:
+            await channel.wait_for_state_change(state)
+            state = channel.get_state(try_to_connect=True)
+    await asyncio.wait_for(wait(), timeout)
+
+def test_overflow_opens_channel_after_max_streams():
+    async def run():
+        server, uri = await start_server()
+        pool = ChannelPool(uri, use_ssl=False, max_streams=2)
+        try:
+            await pool.warm()
+            leases = [pool.acquire() for _ in range(3)]
+            assert len(pool.entries) == 2
+            assert leases[0].channel is leases[1].channel
+            assert leases[2].channel is not leases[0].channel
+            assert all(await asyncio.gather(*[synthesize(lease) for lease in leases]))
+            for lease in leases: lease.release()
+            assert [entry.streams for entry in pool.entries] == [0, 0]
+            with pool.acquire() as lease:
+                assert lease.channel is pool.entries[0].channel
+        finally:
+            await pool.close()
+            await server.stop(None)
+    asyncio.run(run())
+
+def test_unhealthy_channel_is_retired_until_released():
+    async def run():
+        server, uri = await start_server()
+        pool = ChannelPool(uri, use_ssl=False)
+        try:
+            await pool.warm()
+            busy = pool.acquire()
+            await synthesize(busy)
+            await server.stop(None)
+            await wait_unhealthy(busy.channel)
+            fresh = pool.acquire()
+            assert fresh.channel is not busy.channel
+            assert pool.retired == [busy.entry]
+            busy.release()
+            assert pool.retired == []
+            assert [entry.channel for entry in pool.entries] == [fresh.channel]
+            fresh.release()
+        finally:
+            await pool.close()
+            await server.stop(None)
+    asyncio.run(run())
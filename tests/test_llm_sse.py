@@ -0,0 +1,87 @@
+import aiohttp.web
+import asyncio
+import json
+import services.interaction as interaction
+from bench.fakes import FakeLlm
+from services.interaction import SSEParser, sse_delta_content, completions_create, close_llm_client
+
+# SSE parsing and delta extraction, then completions_create against local servers.
+
+def chunk(delta, **choice):
+    return json.dumps({'choices': [{'index': 0, 'delta': delta, **choice}]}).encode('utf-8')
+
+def test_parser_joins_lines_split_across_chunks():
+    parser = SSEParser()
+    stream = b'data: {"a": 1}\r\n\r\n: keep-alive\n\ndata:{"b": 2}\n\nevent: x\ndata: [DONE]\n\n'
+    payloads = []
+    for i in range(len(stream)):
+        payloads += parser.feed(stream[i:i + 1])
+    assert payloads == [b'{"a": 1}', b'{"b": 2}', b'[DONE]']
+    assert parser.feed(b'data: {"c"') == []
+    assert parser.feed(b': 3}\r\n') == [b'{"c": 3}']
+
+def test_delta_content():
+    assert sse_delta_content(chunk({'content': 'Hello'})) == 'Hello'
+    assert sse_delta_content(chunk({'content': 'say "hi"\n\\ok'})) == 'say "hi"\n\\ok'
+    assert sse_delta_content(chunk({'content': 'héllo ✓ 😀'})) == 'héllo ✓ 😀'
+    assert sse_delta_content(json.dumps({'choices': [{'delta': {'content': 'héllo 😀'}}]}, ensure_ascii=False).encode('utf-8')) == 'héllo 😀'
+    assert sse_delta_content(chunk({'role': 'assistant', 'content': None})) is None
+    assert sse_delta_content(chunk({})) is None
+
+def test_delta_content_ignores_other_content_keys():
+    logprobs = {'content': [{'token': 'wrong', 'logprob': -0.1}]}
+    assert sse_delta_content(chunk({'content': 'right'}, logprobs=logprobs)) == 'right'
+    assert sse_delta_content(chunk({'content': None}, logprobs=logprobs)) is None
+    payload = json.dumps({'choices': [{'index': 0, 'logprobs': {'content': 'wrong'}, 'delta': {'content': 'right'}}]}).encode('utf-8')
+    assert sse_delta_content(payload) == 'right'
+    tool_calls = [{'index': 0, 'function': {'name': 'f', 'arguments': '{"content": "wrong"}'}}]
+    assert sse_delta_content(chunk({'tool_calls': tool_calls})) is None
+    assert sse_delta_content(chunk({'tool_calls': tool_calls, 'content': 'right'})) == 'right'
+
+def test_delta_content_skips_usage_only_chunk():
+    assert sse_delta_content(b'{"choices": [], "usage": {"prompt_tokens": 5, "completion_tokens": 2}}') is None
+
+async def serve(handler):
+    app = aiohttp.web.Application()
+    app.router.add_post('/v1/chat/completions', handler)
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}/v1/chat/completions'
+
+async def collect(monkeypatch, handler):
+    runner, url = await serve(handler)
+    monkeypatch.setattr(interaction, 'LLM_URL', url)
+    try:
+        return [content async for content in completions_create([{'role': 'user', 'content': 'hi'}])]
+    finally:
+        await close_llm_client()
+        await runner.cleanup()
+
+def test_completions_stream_split_mid_line(monkeypatch, capsys):
+    async def handler(request):
+        await request.json()
+        stream = b''.join(b'data: ' + payload + b'\r\n\r\n' for payload in [
+            chunk({'role': 'assistant', 'content': None}),
+            chunk({'content': 'Grüße, '}),
+            chunk({'content': '"Dr." 😀'}),
+            b'{"choices": [], "usage": {"completion_tokens": 2}}',
+            b'[DONE]',
+            chunk({'content': 'after done'}),
+        ])
+        response = aiohttp.web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for i in range(0, len(stream), 7):
+            await response.write(stream[i:i + 7])
+            await asyncio.sleep(0)
+        return response
+    assert asyncio.run(collect(monkeypatch, handler)) == ['Grüße, ', '"Dr." 😀']
+    assert 'Error' not in capsys.readouterr().out
+
+def test_completions_against_fake_llm(monkeypatch, capsys):
+    llm = FakeLlm(first_token_ms=0, token_ms=0, tokens=6)
+    contents = asyncio.run(collect(monkeypatch, llm.completions))
+    assert ''.join(contents) == 'Reply 1. word word word word word This is a synthetic answer sentence. '
+    assert 'Error' not in capsys.readouterr().out